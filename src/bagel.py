@@ -1,127 +1,303 @@
+import argparse
+import itertools
 import json
-import requests
-from requests.adapters import HTTPAdapter, Retry
-from collections import defaultdict
+import os
+import zlib
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 
 from comparator.engines.nameres import NameResNEREngine
 from comparator.engines.sapbert import SAPBERTNEREngine
 
-from gpt import ask_labels, ask_classes, ask_classes_and_descriptions
+import gpt
+from candidates import CandidateSet, ReturnParameter, candidates_digest, intern, to_json
+from gpt_output import parse_files
+from gpt import ask_labels, ask_classes, ask_classes_and_descriptions, ask_all, ask_batch, batch_terms
+from local_index import LocalCandidateIndex
+from metrics import metrics
+from nodenorm import NodeNormClient, make_session
+from prefilter import Prefilter, expand, short_circuit
+from previous_output import PreviousOutput
+from term_cache import TermCache
 
 import random
 
-def parse_gpt():
-    with open("gpt4_parsed.jsonl","w") as outf:
-        indir = "../../gpt_output/"
-        for input_file in ["abstracts_CompAndHeal_gpt4_20240320_test.json", "abstracts_CompAndHeal_gpt4_20240320_train.json"]:
-            fname = indir + input_file
-            with open(fname, "r") as file:
-                data = json.loads(file.read())
-            for datum in data:
-                outthing = {}
-                lines = datum["prompt"].split("\n")
-                for line in lines:
-                    if line.startswith("Title: "):
-                        outthing["title"] = line[len("Title: "):]
-                    if line.startswith("Abstract: "):
-                        outthing["abstract"] = line[len("Abstract: "):]
-                outthing["abstract_id"] = datum["abstract_id"]
-                output = datum["output"]
-                intrips = False
-                lines = output.split("\n")
-                outthing["entities"] = []
-                for line in lines:
-                    if intrips:
-                        try:
-                            start = line.index("{")
-                            end = line.rindex("}")
-                        except:
-                            continue
-                        jblob = line[start:end+1]
-                        triple = json.loads(jblob)
-                        outthing["entities"].append({"entity": triple["subject"], "qualifier": triple["subject_qualifier"] })
-                        outthing["entities"].append({"entity": triple["object"], "qualifier": triple["object_qualifier"] })
-                    elif line.startswith("Core Triples"):
-                        intrips = True
-                outf.write(json.dumps(outthing)+"\n")
-
-def go():
-    session = requests.Session()
-    retries = Retry(total=5,
-                    backoff_factor=0.1,
-                    status_forcelist=[ 500, 502, 503, 504, 403 ]
-                    )
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+def parse_gpt(indir="../../gpt_output/", outfile="gpt4_parsed.jsonl", errfile="gpt4_parse_errors.jsonl", workers=None):
+    """Parse the raw GPT output files into outfile, one worker process per file.  Triples that can't be parsed are
+    reported in errfile."""
+    input_files = ["abstracts_CompAndHeal_gpt4_20240320_test.json", "abstracts_CompAndHeal_gpt4_20240320_train.json"]
+    parse_files([os.path.join(indir, f) for f in input_files], outfile, errfile, workers=workers)
+
+def go(infile="gpt4_parsed.jsonl", outfile="bagel_synonyms.jsonl", limit=None, sample=None, seed=0, shard=None,
+       concurrency=1, mode="separate", term_cache=None, checkpoint=None, local_index=None, prefilter=None,
+       metrics_file=None, prometheus_file=None, engines=None, previous=None, nodenorm_url=None):
+    """Run bagel over the parsed abstracts in infile, streaming them rather than reading the whole file.
+    limit stops after that many abstracts, sample takes a reservoir sample of that many with seed, and shard=(i, n)
+    keeps only the abstracts whose id falls in shard i of n.
+    concurrency bounds both the number of abstracts in flight and the number of outstanding NameRes/SAPBERT/GPT calls.
+    Output is written in input order regardless.
+    mode picks how GPT is asked: "separate" makes the three ask_* calls per term, "merged" makes one ask_all call per
+    term, and "abstract" batches all the terms of an abstract into as few ask_batch calls as fit the token budget.
+    term_cache is an optional TermCache of candidate sets shared across abstracts and runs.
+    checkpoint (by default outfile + ".done") records the abstract_ids that have been written.  Those are skipped
+    (after limit, sample and shard have picked the same abstracts as the first time), and the output appended to, so
+    that an interrupted run picks up where it left off.
+    local_index is an optional LocalCandidateIndex to use instead of NameRes and SAPBERT.
+    prefilter is an optional Prefilter applied to each term's candidates before GPT.
+    Per-stage timings, counters and token usage are written to metrics_file as JSON and, optionally, to
+    prometheus_file in Prometheus text format.
+    engines is an optional (engines, lookup) pair, as returned by make_engines, to use instead.
+    previous is an optional PreviousOutput of an earlier run.  Terms whose candidates are unchanged since then keep
+    their previous results instead of going to GPT again.  outfile has to be a different file.
+    nodenorm_url overrides NODENORM_URL for this run."""
+    if previous is not None and os.path.abspath(previous.path) == os.path.abspath(outfile):
+        raise ValueError(f"{outfile} is the previous output; write the merged output to a new file")
+    if checkpoint is None:
+        checkpoint = outfile + ".done"
+    done = load_checkpoint(checkpoint)
+    if len(done) > 0:
+        print(f"Resuming: {len(done)} abstracts already done")
+    # Select from the whole input before skipping what's done, so that a resumed run finishes the same selection
+    papers = read_papers(infile, shard=shard)
+    if sample is not None:
+        papers = reservoir_sample(papers, sample, seed)
+    if limit is not None:
+        papers = itertools.islice(papers, limit)
+    papers = (paper for paper in papers if str(paper["abstract_id"]) not in done)
+
+    session = make_session(pool_size=max(10, concurrency))
+    engines, lookup = engines if engines is not None else make_engines(session, local_index)
+    if prefilter is not None and prefilter.sources != set(source for source, engine in engines):
+        raise ValueError(f"The prefilter expects candidates from {sorted(prefilter.sources)}, not from {[source for source, engine in engines]}")
+    nodenorm = NodeNormClient(session, url=nodenorm_url)
+    taxon_id_to_name = {}
+    # Papers are coordinated on one pool, and the network calls they fan out go to another, so that a paper
+    # waiting on its calls can never starve the pool those calls need.
+    with ThreadPoolExecutor(max_workers=concurrency) as paper_pool, ThreadPoolExecutor(max_workers=concurrency) as call_pool:
+        def run(paper):
+            return bagel_paper(paper, engines, lookup, nodenorm, taxon_id_to_name, call_pool, mode=mode, term_cache=term_cache, prefilter=prefilter, previous=previous)
+        with open(outfile, "a") as outf, open(checkpoint, "a") as donef:
+            for output_paper in ordered_map(paper_pool, run, papers, window=2*concurrency):
+                outf.write(json.dumps(output_paper, default=to_json)+"\n")
+                outf.flush()
+                donef.write(f"{output_paper['abstract_id']}\n")
+                donef.flush()
+                metrics.count("abstracts")
+    if gpt.cache is not None:
+        print("LLM cache", gpt.cache.stats())
+    if term_cache is not None:
+        print("Term cache", term_cache.stats())
+    if previous is not None:
+        print("Previous output", previous.stats())
+    if metrics_file is not None:
+        metrics.write_json(metrics_file)
+    if prometheus_file is not None:
+        metrics.write_prometheus(prometheus_file)
+
+def load_checkpoint(checkpoint):
+    """The set of abstract_ids (as strings) recorded in a checkpoint file."""
+    if not os.path.isfile(checkpoint):
+        return set()
+    with open(checkpoint, "r") as inf:
+        return set(line.strip() for line in inf if line.strip())
+
+def in_shard(abstract_id, shard):
+    i, n = shard
+    return zlib.crc32(str(abstract_id).encode("utf-8")) % n == i
+
+def read_papers(infile, shard=None, skip=()):
+    """Stream the papers of a parsed jsonl file, keeping those in shard and not in skip."""
+    with open(infile, "r") as inf:
+        for line in inf:
+            if not line.strip():
+                continue
+            paper = json.loads(line)
+            if str(paper["abstract_id"]) in skip:
+                continue
+            if shard is not None and not in_shard(paper["abstract_id"], shard):
+                continue
+            yield paper
+
+def reservoir_sample(items, k, seed=None):
+    """A uniform random sample of k items from a stream, holding only k of them in memory."""
+    rng = random.Random(seed)
+    reservoir = []
+    for i, item in enumerate(items):
+        if i < k:
+            reservoir.append(item)
+        else:
+            j = rng.randint(0, i)
+            if j < k:
+                reservoir[j] = item
+    return reservoir
+
+def ordered_map(pool, fn, items, window):
+    """Like pool.map, but only keeps window items in flight, so that items can be an unbounded stream."""
+    futures = deque()
+    for item in items:
+        futures.append(pool.submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+METHODS = ["label", "class", "class_description"]
+
+def bagel_paper(paper, engines, lookup, nodenorm, taxon_id_to_name, pool, mode="separate", term_cache=None, prefilter=None,
+                previous=None):
+    """Run every entity of a parsed paper through NER, NodeNorm and GPT.  The individual NER and GPT calls are
+    submitted to pool.  Candidate sets come from term_cache when it has them.  If a Prefilter is given, candidates
+    are pruned before GPT sees them, and terms with an obvious exact match skip GPT altogether.  If a PreviousOutput
+    is given, terms whose candidates it has seen for this abstract take their previous results."""
+    abstract = paper["abstract"]
+    abstract_id = paper['abstract_id']
+    entities = sorted(set([e["entity"] for e in paper["entities"]]))
+    output_paper = {"abstract": abstract, "abstract_id": abstract_id, "bagel_results": defaultdict(dict)}
+    term_sets = get_candidates(entities, engines, lookup, nodenorm, taxon_id_to_name, pool, term_cache)
+    reused = {}
+    if previous is not None:
+        reused = previous.reusable(abstract_id, {term: candidates_digest(terms.values()) for term, terms in term_sets.items()})
+        metrics.count("terms.reused", len(reused))
+    plans = {}
+    for term, terms in term_sets.items():
+        if term not in reused:
+            plans[term] = prefilter.plan(term, terms) if prefilter is not None else (terms, {}, None)
+    to_ask = {term: plans[term][0] for term in entities if term in plans and plans[term][0]}
+    answers = ask_gpt(abstract, abstract_id, to_ask, pool, mode)
+    # Terms with no candidates left to ask about never reach GPT, and get empty results
+    answers = {term: answers.get(term, {method: {} for method in METHODS}) for term in plans}
+    for term in entities:
+        if term in reused:
+            output_paper["bagel_results"][term] = reused[term]
+            continue
+        prompt_terms, aliases, exact = plans[term]
+        if prefilter is None:
+            output_paper["bagel_results"][term].update(answers[term])
+        elif exact is not None:
+            for method in METHODS:
+                output_paper["bagel_results"][term][method] = short_circuit(term_sets[term], exact, aliases)
+        else:
+            for method in METHODS:
+                output_paper["bagel_results"][term][method] = expand(term_sets[term], answers[term][method], aliases)
+    return output_paper
+
+def ask_gpt(abstract, abstract_id, term_sets, pool, mode="separate"):
+    """Get the label, class and class_description judgments for each of term_sets from GPT, as
+    {term: {method: grouped_by_syntype}}.  The calls made depend on mode; see go()."""
+    if mode == "abstract":
+        batch_futures = [pool.submit(metrics.timed("ask_batch", ask_batch), abstract, batch, abstract_id=abstract_id, out_file_path="./gpt_out_batched.jsonl")
+                         for batch in batch_terms(abstract, term_sets)]
+        resolved = {}
+        for future in batch_futures:
+            resolved.update(future.result())
+        return resolved
+    if mode == "merged":
+        gpt_futures = {term: pool.submit(metrics.timed("ask_all", ask_all), abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_merged.jsonl")
+                       for term, terms in term_sets.items()}
+        return {term: future.result() for term, future in gpt_futures.items()}
+    gpt_futures = {}
+    for term, terms in term_sets.items():
+        gpt_futures[term] = {
+            "label": pool.submit(metrics.timed("ask_labels", ask_labels), abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_label.jsonl"),
+            "class": pool.submit(metrics.timed("ask_classes", ask_classes), abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_classes.jsonl"),
+            "class_description": pool.submit(metrics.timed("ask_classes_and_descriptions", ask_classes_and_descriptions), abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_classes_and_descriptions.jsonl")
+        }
+    return {term: {method: future.result() for method, future in futures.items()} for term, futures in gpt_futures.items()}
+
+def make_engines(session, local_index=None):
+    """The candidate engines as [(source, engine)], and the engine to use for reverse lookups.  That's NameRes and
+    SAPBERT, unless a LocalCandidateIndex is given to replace both."""
+    if local_index is not None:
+        return [("Local", local_index)], local_index
     nameres = NameResNEREngine(session)
     sapbert = SAPBERTNEREngine(session)
-    with open("gpt4_parsed.jsonl", "r") as inf:
-        lines = inf.readlines()
-    random.shuffle(lines)
+    return [("NameRes", nameres), ("SAPBert", sapbert)], nameres
+
+def get_candidates(entities, engines, lookup, nodenorm, taxon_id_to_name, pool, term_cache=None):
+    """Return {term: candidates} for each of entities, where candidates is the merged {curie: Candidate} CandidateSet from
+    each of engines, augmented from lookup and NodeNorm.  Terms found in term_cache are not looked up again; the rest
+    are, and are then added to it."""
+    term_sets = {}
+    if term_cache is not None:
+        for term in entities:
+            cached = term_cache.get(term)
+            if cached is not None:
+                term_sets[term] = cached
+                metrics.count("term_cache.hit")
+            else:
+                metrics.count("term_cache.miss")
+    missing = [term for term in entities if term not in term_sets]
+    ner_futures = {}
+    for term in missing:
+        ner_futures[term] = [(source, pool.submit(metrics.timed("annotate", engine.annotate, source), term, props={}, limit=10)) for source, engine in engines]
+    new_sets = {}
+    for term in missing:
+        # We have results from each engine (nr and sb). But we want to fill those out with consistent information
+        # that may or may not be returned from each source
+        # First merge the results by identifier (not label)
+        terms = CandidateSet()
+        for source, future in ner_futures[term]:
+            update_by_id(terms, future.result(), source)
+        new_sets[term] = terms
+    # One NodeNorm batch for every new candidate
+    augment_abstract(list(new_sets.values()), lookup, nodenorm, taxon_id_to_name)
+    for term, terms in new_sets.items():
+        if term_cache is not None:
+            term_cache.put(term, terms)
+        term_sets[term] = terms
+    return {term: term_sets[term] for term in entities}
+
+def prewarm_term_cache(term_cache, infile="gpt4_parsed.jsonl", concurrency=1, chunk_size=50, local_index=None):
+    """Fill term_cache with the candidates for every distinct entity in a parsed corpus, so that a later go() only
+    has to make the GPT calls."""
+    session = make_session(pool_size=max(10, concurrency))
+    engines, lookup = make_engines(session, local_index)
+    nodenorm = NodeNormClient(session)
+    entities = set()
+    with open(infile, "r") as inf:
+        for line in inf:
+            entities.update(e["entity"] for e in json.loads(line)["entities"])
+    entities = sorted(e for e in entities if e not in term_cache)
     taxon_id_to_name = {}
-    with open("bagel_synonyms.jsonl","w") as outf:
-        for line in lines[:2]:
-            paper = json.loads(line)
-            abstract = paper["abstract"]
-            abstract_id = paper['abstract_id']
-            entities = list(set([e["entity"] for e in paper["entities"]]))
-            output_paper = {"abstract": abstract, "abstract_id": abstract_id, "bagel_results": defaultdict(dict)}
-            for term in entities:
-                nr_results = nameres.annotate(term, props={}, limit=10)
-                sb_results = sapbert.annotate(term, props={}, limit=10)
-                # We have results from both nr and sb. But we want to fill those out with consistent information that may
-                # or may not be returned from each source
-                # First merge the results by identifier (not label)
-                terms = defaultdict(lambda: {"return_parameters": []})
-                update_by_id(terms, nr_results, "NameRes")
-                update_by_id(terms, sb_results, "SAPBert")
-                augment_results(terms, nameres, taxon_id_to_name)
-                gpt_class_desc_response = ask_classes_and_descriptions(abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_classes_and_descriptions.json")
-                gpt_label_response = ask_labels(abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_label.json")
-                gpt_class_response = ask_classes(abstract, term, terms, abstract_id=abstract_id, out_file_path="./gpt_out_classes.json")
-                output_paper["bagel_results"][term]["label"] = gpt_label_response
-                output_paper["bagel_results"][term]["class"] = gpt_class_response
-                output_paper["bagel_results"][term]["class_description"] = gpt_class_desc_response
-            outf.write(json.dumps(output_paper)+"\n")
-
-def augment_results(terms, nameres,taxes):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(0, len(entities), chunk_size):
+            get_candidates(entities[i:i+chunk_size], engines, lookup, nodenorm, taxon_id_to_name, pool, term_cache)
+            print(f"Warmed {min(i+chunk_size, len(entities))}/{len(entities)} terms")
+
+def augment_results(terms, nameres, nodenorm, taxes):
     """Given a dict where the key is a curie, and the value are data about the match, augment the value with
     results from nameres's reverse lookup.
     For cases where we get back a taxa, add the taxa name to the label of the item."""
-    curies = list(terms.keys())
-    augs = nameres.reverse_lookup(curies)
-    for curie in augs:
-        terms[curie].update(augs[curie])
-        resp = requests.get("https://nodenormalization-sri.renci.org/get_normalized_nodes?curie="+curie+"&conflate=true&drug_chemical_conflate=true&description=true")
-        if resp.status_code == 200:
-            result = resp.json()
-            try:
-                terms[curie]["description"] = result[curie]["id"].get("description","")
-            except:
-                print("No curie?",curie)
-                terms[curie]["description"] = ""
-    for curie, annotation in terms.items():
-        if len(annotation["taxa"]) > 0:
-            tax_id = annotation["taxa"][0]
-            if tax_id not in taxes:
-                resp = requests.get("https://nodenormalization-sri.renci.org/get_normalized_nodes?curie="+tax_id)
-                if resp.status_code == 200:
-                    result = resp.json()
-                    tax_name = result[tax_id]["id"]["label"]
-                    taxes[tax_id] = tax_name
-            tax_name = taxes[tax_id]
-            annotation["label"] = f"{annotation['label']} ({tax_name})"
+    augment_abstract([terms], nameres, nodenorm, taxes)
+
+def augment_abstract(term_sets, nameres, nodenorm, taxes):
+    """augment_results for several terms' candidate dicts at once, so that NodeNorm gets a single batched request
+    for all of the descriptions and taxon names."""
+    curies = list(dict.fromkeys(curie for terms in term_sets for curie in terms))
+    if len(curies) == 0:
+        return
+    with metrics.timer("reverse_lookup"):
+        augs = nameres.reverse_lookup(curies)
+    for terms in term_sets:
+        for curie in terms:
+            if curie in augs:
+                terms[curie].update(augs[curie])
+    tax_ids = [augs[curie]["taxa"][0] for curie in augs if len(augs[curie].get("taxa", [])) > 0]
+    descriptions, taxes = nodenorm.describe(list(augs.keys()), tax_ids, taxes)
+    for terms in term_sets:
+        for curie, annotation in terms.items():
+            if curie in descriptions:
+                annotation.description = descriptions[curie]
+            if annotation.taxa:
+                tax_id = annotation.taxa[0]
+                if tax_id in taxes:
+                    annotation.label = intern(f"{annotation.label} ({taxes[tax_id]})")
 
 def update_by_id(terms, results, source):
     for i,result in enumerate(results):
-        r = {}
-        #r["label"] = result["label"]
-        r["source"] = source
-        r["score"] = result["score"]
-        r["rank"] = i+1
         identifier = result["id"]
-        terms[identifier]["return_parameters"].append(r)
-        terms[identifier]["label"] = result["label"]
+        terms[identifier].return_parameters.append(ReturnParameter(source, result["score"], i+1))
+        terms[identifier].label = intern(result["label"])
 
 
 def update_by_label(terms, results, source):
@@ -135,13 +311,7 @@ def update_by_label(terms, results, source):
         terms[label].append(r)
 
 def bagel_it(term):
-    session = requests.Session()
-    retries = Retry(total=5,
-                    backoff_factor=0.1,
-                    status_forcelist=[ 500, 502, 503, 504, 403 ]
-                    )
-    session.mount('http://', HTTPAdapter(max_retries=retries))
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    session = make_session()
     nameres = NameResNEREngine(session)
     sapbert = SAPBERTNEREngine(session)
     nr_results = nameres.annotate(term, props={}, limit=10)
@@ -150,9 +320,92 @@ def bagel_it(term):
     update_by_label(terms, nr_results, "NameRes")
     update_by_label(terms, sb_results, "Sapbert")
 
-if __name__ == "__main__":
-    #parse_gpt()
-    go()
-    #bagel_it("amygdala")
+def parse_shard(value):
+    i, n = value.split("/")
+    i, n = int(i), int(n)
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard {value} should be i/N with 0 <= i < N")
+    return i, n
 
+def main():
+    parser = argparse.ArgumentParser(description="Ground entities from parsed GPT output with NameRes, SAPBERT and GPT.")
+    subparsers = parser.add_subparsers(dest="command")
+    parse_parser = subparsers.add_parser("parse", help="Parse the raw GPT output files into gpt4_parsed.jsonl")
+    parse_parser.add_argument("--indir", default="../../gpt_output/")
+    parse_parser.add_argument("--output", default="gpt4_parsed.jsonl")
+    parse_parser.add_argument("--errors", default="gpt4_parse_errors.jsonl")
+    parse_parser.add_argument("--workers", type=int)
+    run_parser = subparsers.add_parser("go", help="Run bagel over a parsed corpus")
+    run_parser.add_argument("--input", default="gpt4_parsed.jsonl")
+    run_parser.add_argument("--output", default="bagel_synonyms.jsonl")
+    run_parser.add_argument("--limit", type=int, help="Process at most this many abstracts")
+    run_parser.add_argument("--sample", type=int, help="Process a random sample of this many abstracts")
+    run_parser.add_argument("--seed", type=int, default=0, help="Seed for --sample; resume with the same seed to finish the same sample")
+    run_parser.add_argument("--shard", type=parse_shard, help="Only process shard i of N, given as i/N")
+    run_parser.add_argument("--concurrency", type=int, default=1)
+    run_parser.add_argument("--mode", choices=["separate", "merged", "abstract"], default="separate")
+    run_parser.add_argument("--prefilter", action="store_true", help="Prune candidates and skip GPT for obvious exact matches")
+    run_parser.add_argument("--min-nameres-score", type=float, help="With --prefilter, drop NameRes candidates scoring below this")
+    run_parser.add_argument("--min-sapbert-score", type=float, help="With --prefilter, drop SAPBert candidates scoring below this")
+    run_parser.add_argument("--max-rank", type=int, help="With --prefilter, drop candidates no engine ranked this high")
+    run_parser.add_argument("--metrics", help="Write a JSON summary of timings, counters and tokens here")
+    run_parser.add_argument("--prometheus", help="Also write the metrics here in Prometheus text format")
+    run_parser.add_argument("--previous", help="Earlier output to reuse the results of terms whose candidates haven't changed")
+    run_parser.add_argument("--checkpoint", help="File of completed abstract_ids (default: OUTPUT.done)")
+    run_parser.add_argument("--term-cache", help="SQLite file for cached candidate sets")
+    run_parser.add_argument("--local-index", help="LocalCandidateIndex file to use instead of NameRes and SAPBERT")
+    run_parser.add_argument("--llm-cache", help="SQLite file for cached GPT responses")
+    run_parser.add_argument("--replay", action="store_true", help="Only use responses already in --llm-cache")
+    run_parser.add_argument("--llm-url", help="Base URL of an OpenAI-compatible API (default: OPENAI_BASE_URL or OpenAI)")
+    run_parser.add_argument("--rpm", type=int, default=500, help="GPT requests per minute")
+    run_parser.add_argument("--tpm", type=int, default=300000, help="GPT tokens per minute")
+    run_parser.add_argument("--llm-workers", type=int, default=8, help="Maximum GPT requests in flight")
+    run_parser.add_argument("--compact-prompts", action="store_true", help="Send GPT an abstract window and numbered synonym rows instead of the full prompts")
+    run_parser.add_argument("--context-sentences", type=int, default=1, help="With --compact-prompts, sentences to keep around each mention of a term")
+    run_parser.add_argument("--description-tokens", type=int, default=48, help="With --compact-prompts, tokens to keep of each description")
+    run_parser.add_argument("--max-repairs", type=int, default=2, help="Repair prompts to try on a malformed GPT response")
+    run_parser.add_argument("--dead-letter", help="Where to record GPT responses that couldn't be repaired (default: BAGEL_DEAD_LETTER or gpt_dead_letter.jsonl)")
+    warm_parser = subparsers.add_parser("prewarm", help="Fill the term cache from the entities of a parsed corpus")
+    warm_parser.add_argument("--input", default="gpt4_parsed.jsonl")
+    warm_parser.add_argument("--term-cache", default="term_cache.sqlite")
+    warm_parser.add_argument("--concurrency", type=int, default=1)
+    warm_parser.add_argument("--local-index", help="LocalCandidateIndex file to use instead of NameRes and SAPBERT")
+    args = parser.parse_args()
 
+    if args.command == "parse":
+        parse_gpt(indir=args.indir, outfile=args.output, errfile=args.errors, workers=args.workers)
+    elif args.command == "go":
+        gpt.configure_client(base_url=args.llm_url, rpm=args.rpm, tpm=args.tpm, workers=args.llm_workers)
+        gpt.max_repairs = args.max_repairs
+        if args.compact_prompts:
+            gpt.configure_prompts(context_sentences=args.context_sentences, description_tokens=args.description_tokens)
+        if args.dead_letter is not None:
+            gpt.dead_letter = args.dead_letter
+        if args.llm_cache is not None:
+            gpt.use_cache(args.llm_cache, replay=args.replay)
+        term_cache = TermCache(args.term_cache) if args.term_cache is not None else None
+        local_index = LocalCandidateIndex(args.local_index) if args.local_index is not None else None
+        previous = PreviousOutput(args.previous) if args.previous is not None else None
+        prefilter = None
+        if args.prefilter:
+            min_scores = {}
+            if args.min_nameres_score is not None:
+                min_scores["NameRes"] = args.min_nameres_score
+            if args.min_sapbert_score is not None:
+                min_scores["SAPBert"] = args.min_sapbert_score
+            sources = ["Local"] if local_index is not None else ["NameRes", "SAPBert"]
+            prefilter = Prefilter(sources, min_scores=min_scores, max_rank=args.max_rank)
+        go(infile=args.input, outfile=args.output, limit=args.limit, sample=args.sample, seed=args.seed,
+           shard=args.shard, concurrency=args.concurrency, mode=args.mode, term_cache=term_cache,
+           checkpoint=args.checkpoint, local_index=local_index, prefilter=prefilter,
+           metrics_file=args.metrics, prometheus_file=args.prometheus, previous=previous)
+    elif args.command == "prewarm":
+        local_index = LocalCandidateIndex(args.local_index) if args.local_index is not None else None
+        prewarm_term_cache(TermCache(args.term_cache), infile=args.input, concurrency=args.concurrency,
+                           local_index=local_index)
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
+    #bagel_it("amygdala")
@@ -0,0 +1,161 @@
+import argparse
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import bagel
+import gpt
+import parse_exacts
+from candidates import CandidateSet
+from fake_services import Fixtures, FakeServices, HTTPEngine
+from gpt_output import parse_file, parse_files
+from nodenorm import NodeNormClient, make_session
+from prompt_log import close_logs
+
+# The fake services run in this process, so benchmarks that call them also count their allocations
+WITH_SERVICES = "python heap, incl. fake services"
+
+def percentile(samples, q):
+    """The nearest-rank q-th quantile of samples, or None if there are none."""
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def measure(name, fn, items, peak_of="python heap"):
+    """Run fn on each of items, timing each call and tracking peak Python memory with tracemalloc.  Returns a result
+    row; peak_of says what its peak_mb covers."""
+    latencies = []
+    tracemalloc.start()
+    start = time.perf_counter()
+    for item in items:
+        t = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"benchmark": name, "items": len(latencies), "seconds": elapsed,
+            "throughput": len(latencies) / elapsed if elapsed > 0 else None,
+            "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            "p90_latency": percentile(latencies, 0.9), "peak_mb": peak / 2**20, "peak_of": peak_of}
+
+def write_gpt_dump(papers, fname):
+    """A raw GPT output file, as parse_gpt expects, that parses back into papers."""
+    data = []
+    for paper in papers:
+        entities = [e["entity"] for e in paper["entities"]]
+        triples = [{"subject": s, "subject_qualifier": None, "predicate": "related_to", "object": o, "object_qualifier": None}
+                   for s, o in zip(entities[0::2], entities[1::2])]
+        output = "Summary\n...\nCore Triples\n```\n" + "\n".join(json.dumps(t) for t in triples) + "\n```"
+        data.append({"abstract_id": paper["abstract_id"],
+                     "prompt": f"Title: {paper.get('title', '')}\nAbstract: {paper['abstract']}\n",
+                     "output": output})
+    with open(fname, "w") as outf:
+        json.dump(data, outf)
+
+def candidate_sets(fixtures, paper):
+    term_sets = {}
+    for term in sorted(set(e["entity"] for e in paper["entities"])):
+        terms = CandidateSet()
+        for source in ("NameRes", "SAPBert"):
+            bagel.update_by_id(terms, fixtures.annotations[source].get(term, []), source)
+        term_sets[term] = terms
+    return term_sets
+
+def run(latency, concurrency=8, mode="separate", limit=None, repeat=1, seed=42, workdir=None, compact=False):
+    """Run every benchmark against fake services with the given per-service latency, with compact prompts if compact
+    is set.  Returns the result rows."""
+    fixtures = Fixtures()
+    papers = fixtures.papers[:limit] if limit is not None else fixtures.papers
+    services = FakeServices(fixtures, latency).start()
+    gpt.configure_client(base_url=f"{services.url}/openai/v1", rpm=100000, tpm=100000000, workers=max(8, concurrency))
+    gpt.configure_prompts(compact=compact)
+    session = make_session(pool_size=max(10, concurrency))
+    nameres = HTTPEngine(session, f"{services.url}/nameres")
+    sapbert = HTTPEngine(session, f"{services.url}/sapbert")
+    nodenorm_url = f"{services.url}/nodenorm/get_normalized_nodes"
+    nodenorm = NodeNormClient(session, url=nodenorm_url)
+    here = os.getcwd()
+    workdir = workdir or tempfile.mkdtemp(prefix="bagel_bench_")
+    results = []
+    try:
+        os.chdir(workdir)
+
+        dumps = []
+        rng = random.Random(seed)
+        for i in range(2):
+            dump = os.path.join(workdir, f"gpt_dump_{i}.json")
+            write_gpt_dump([rng.choice(papers) for _ in range(len(papers) * repeat)], dump)
+            dumps.append(dump)
+        # parse_files does its work in worker processes, which tracemalloc can't see, so the parsing itself is
+        # measured in this process, and the parallel run by the largest worker's resident memory
+        results.append(measure("parse_gpt", lambda dump: parse_file(dump, "parsed.jsonl", "parse_errors.jsonl"), dumps))
+        results.append(measure("parse_gpt[processes]", lambda _: parse_files(dumps, "parsed.jsonl", "parse_errors.jsonl"), [None]))
+        # ru_maxrss is in kilobytes on Linux
+        results[-1]["peak_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10
+        results[-1]["peak_of"] = "largest worker RSS"
+
+        results.append(measure("augment_results",
+                               lambda paper: bagel.augment_abstract(list(candidate_sets(fixtures, paper).values()), nameres, nodenorm, {}),
+                               papers, WITH_SERVICES))
+
+        asks = [(paper["abstract"], term, terms) for paper in papers[:10] for term, terms in candidate_sets(fixtures, paper).items()]
+        bagel.augment_abstract([terms for _, _, terms in asks], nameres, nodenorm, {})
+        for ask in (gpt.ask_labels, gpt.ask_classes, gpt.ask_classes_and_descriptions, gpt.ask_all):
+            results.append(measure(ask.__name__, lambda a: ask(a[0], a[1], a[2]), asks, WITH_SERVICES))
+
+        with open("input.jsonl", "w") as outf:
+            for paper in papers * repeat:
+                outf.write(json.dumps(paper) + "\n")
+        results.append(measure(f"go[{mode}, concurrency={concurrency}]",
+                               lambda _: bagel.go(infile="input.jsonl", outfile="bench_synonyms.jsonl", concurrency=concurrency,
+                                                  mode=mode, checkpoint="bench_synonyms.done",
+                                                  engines=([("NameRes", nameres), ("SAPBert", sapbert)], nameres),
+                                                  nodenorm_url=nodenorm_url),
+                               [None], WITH_SERVICES))
+        results[-1]["items"] = len(papers) * repeat
+        results[-1]["throughput"] = results[-1]["items"] / results[-1]["seconds"]
+
+        results.append(measure("parse_exacts.go", lambda _: parse_exacts.go(["bench_synonyms.jsonl"], "exacts.tsv"), [None]))
+    finally:
+        close_logs()
+        os.chdir(here)
+        services.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def report(results):
+    print(f"{'benchmark':40} {'items':>6} {'seconds':>9} {'items/s':>9} {'mean ms':>9} {'p90 ms':>9} {'peak MB':>8}  peak of")
+    for r in results:
+        mean = r["mean_latency"] * 1000 if r["mean_latency"] is not None else float("nan")
+        p90 = r["p90_latency"] * 1000 if r["p90_latency"] is not None else float("nan")
+        print(f"{r['benchmark']:40} {r['items']:>6} {r['seconds']:>9.3f} {r['throughput']:>9.1f} {mean:>9.1f} {p90:>9.1f} {r['peak_mb']:>8.1f}  {r['peak_of']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bagel pipeline offline against fake services.")
+    parser.add_argument("--nameres-latency", type=float, default=0.05)
+    parser.add_argument("--sapbert-latency", type=float, default=0.1)
+    parser.add_argument("--nodenorm-latency", type=float, default=0.05)
+    parser.add_argument("--openai-latency", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--mode", choices=["separate", "merged", "abstract"], default="separate")
+    parser.add_argument("--compact-prompts", action="store_true", help="Benchmark the compact prompts")
+    parser.add_argument("--limit", type=int, help="Only use this many of the recorded abstracts")
+    parser.add_argument("--repeat", type=int, default=1, help="Run go over the abstracts this many times")
+    parser.add_argument("--json", help="Also write the results here")
+    args = parser.parse_args()
+    latency = {"nameres": args.nameres_latency, "sapbert": args.sapbert_latency, "nodenorm": args.nodenorm_latency,
+               "openai": args.openai_latency}
+    results = run(latency, concurrency=args.concurrency, mode=args.mode, limit=args.limit, repeat=args.repeat,
+                  compact=args.compact_prompts)
+    report(results)
+    if args.json is not None:
+        with open(args.json, "w") as outf:
+            json.dump(results, outf, indent=4)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import sys
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+class ReturnParameter:
+    """Where one engine ranked a candidate."""
+    __slots__ = ("source", "score", "rank")
+
+    def __init__(self, source, score, rank):
+        self.source = intern(source)
+        self.score = score
+        self.rank = rank
+
+    def to_json(self):
+        return {"source": self.source, "score": self.score, "rank": self.rank}
+
+class Candidate:
+    """One possible match for a term.  Curies, labels, biolink types and sources are interned, since the same
+    candidates come back for many terms.  Fields that were never filled in are None and left out of the JSON."""
+    __slots__ = ("curie", "label", "biolink_type", "clique_identifier_count", "taxa", "description", "return_parameters")
+
+    def __init__(self, curie, label=None, biolink_type=None, clique_identifier_count=None, taxa=None, description=None,
+                 return_parameters=None):
+        self.curie = intern(curie)
+        self.label = intern(label)
+        self.biolink_type = intern(biolink_type)
+        self.clique_identifier_count = clique_identifier_count
+        self.taxa = tuple(intern(t) for t in taxa) if taxa is not None else None
+        self.description = description
+        self.return_parameters = return_parameters if return_parameters is not None else []
+
+    def update(self, lookup):
+        """Fill in fields from a NameRes reverse_lookup result."""
+        for field in ("label", "biolink_type", "clique_identifier_count", "taxa", "description"):
+            if field in lookup:
+                setattr(self, field, lookup[field])
+        self.label = intern(self.label)
+        self.biolink_type = intern(self.biolink_type)
+        if self.taxa is not None:
+            self.taxa = tuple(intern(t) for t in self.taxa)
+
+    def to_json(self, synonym_type=None):
+        """The dict this candidate has always been written as, with synonym_Type if a judgment matched it."""
+        out = {"return_parameters": [r.to_json() for r in self.return_parameters]}
+        for field in ("label", "biolink_type", "clique_identifier_count"):
+            value = getattr(self, field)
+            if value is not None:
+                out[field] = value
+        if self.taxa is not None:
+            out["taxa"] = list(self.taxa)
+        if self.description is not None:
+            out["description"] = self.description
+        if synonym_type is not None:
+            out["synonym_Type"] = synonym_type
+        out["curie"] = self.curie
+        return out
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["curie"], data.get("label"), data.get("biolink_type"), data.get("clique_identifier_count"),
+                   data.get("taxa"), data.get("description"),
+                   [ReturnParameter(r["source"], r["score"], r["rank"]) for r in data.get("return_parameters", [])])
+
+class CandidateSet(dict):
+    """{curie: Candidate} for one term.  Looking up a new curie adds an empty Candidate for it."""
+    def __missing__(self, curie):
+        candidate = Candidate(curie)
+        self[curie] = candidate
+        return candidate
+
+    def to_json(self):
+        return {curie: candidate.to_json() for curie, candidate in self.items()}
+
+    @classmethod
+    def from_json(cls, data):
+        candidates = cls()
+        for curie, candidate in data.items():
+            candidates[curie] = Candidate.from_json(dict(candidate, curie=curie))
+        return candidates
+
+class Judgment:
+    """A candidate as GPT judged it for one method.  The three methods' judgments share the same Candidate."""
+    __slots__ = ("candidate", "synonym_type")
+
+    def __init__(self, candidate, synonym_type):
+        self.candidate = candidate
+        self.synonym_type = synonym_type
+
+    @property
+    def curie(self):
+        return self.candidate.curie
+
+    def to_json(self):
+        return self.candidate.to_json(self.synonym_type if self.synonym_type != "unrelated" else None)
+
+def candidates_digest(candidates):
+    """A hash of what GPT is shown of a set of candidates: each one's curie, label, biolink type and description.
+    candidates can be Candidates or candidate dicts as written to bagel output, which hash the same."""
+    rows = []
+    for c in candidates:
+        if isinstance(c, dict):
+            rows.append((c["curie"], c.get("label"), c.get("biolink_type"), c.get("description")))
+        else:
+            rows.append((c.curie, c.label, c.biolink_type, c.description))
+    rows.sort(key=lambda row: row[0])
+    return hashlib.sha1(json.dumps(rows).encode("utf-8")).digest()
+
+def to_json(obj):
+    """json.dumps default= hook for the candidate classes."""
+    if hasattr(obj, "to_json"):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
@@ -0,0 +1,191 @@
+import json
+import re
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompts import cell
+
+METHODS = ["label", "class", "class_description"]
+
+def base_label(annotation):
+    """The label NameRes returned, before augment_results appended the taxon name."""
+    label = annotation.get("label", "")
+    if len(annotation.get("taxa", [])) > 0 and label.endswith(")") and " (" in label:
+        return label[:label.rindex(" (")]
+    return label
+
+def by_row(answer, rows):
+    """answer with each synonym replaced by the number of its row in the numbered synonym list in rows.  Synonyms
+    that aren't listed are dropped."""
+    by_label = {}
+    by_class = {}
+    for n, label, cls in re.findall(r"^\s*(\d+) \| ([^|\n]*?)(?: \| ([^|\n]*?))?(?: \|.*)?$", rows, re.MULTILINE):
+        by_label.setdefault(label, int(n))
+        by_class.setdefault((label, cls), int(n))
+    numbered = []
+    for a in answer:
+        if "vocabulary class" in a:
+            row = by_class.get((cell(a["synonym"]), cell(a["vocabulary class"])))
+        else:
+            row = by_label.get(cell(a["synonym"]))
+        if row is not None:
+            numbered.append({"synonym": row, "synonymType": a["synonymType"]})
+    return numbered
+
+class Fixtures:
+    """NameRes, SAPBERT, NodeNorm and GPT responses recovered from bagel output (bagel_synonyms*.jsonl), so the
+    pipeline can be replayed against them offline."""
+    def __init__(self, output_files=("bagel_synonyms.jsonl", "bagel_synonyms_1.jsonl")):
+        self.annotations = {"NameRes": defaultdict(list), "SAPBert": defaultdict(list)}
+        self.reverse = {}
+        self.nodes = {}
+        self.answers = {}
+        self.papers = []
+        for output_file in output_files:
+            with open(output_file, "r") as inf:
+                for line in inf:
+                    self.add_paper(json.loads(line))
+
+    def add_paper(self, doc):
+        self.papers.append({"abstract": doc["abstract"], "abstract_id": doc["abstract_id"],
+                            "entities": [{"entity": term, "qualifier": None} for term in doc["bagel_results"]]})
+        for term, results in doc["bagel_results"].items():
+            candidates = [c for grouped in results.get("class_description", {}).values() for c in grouped]
+            ranked = defaultdict(list)
+            for c in candidates:
+                label = base_label(c)
+                for r in c.get("return_parameters", []):
+                    ranked[r["source"]].append((r["rank"], {"id": c["curie"], "label": label, "score": r["score"]}))
+                self.reverse[c["curie"]] = {"label": label, "biolink_type": c.get("biolink_type", ""),
+                                            "taxa": c.get("taxa", []),
+                                            "clique_identifier_count": c.get("clique_identifier_count", 1)}
+                self.nodes[c["curie"]] = {"id": {"identifier": c["curie"], "label": label,
+                                                 "description": c.get("description", "")}}
+                if len(c.get("taxa", [])) > 0 and c["label"] != label:
+                    tax_name = c["label"][len(label) + 2:-1]
+                    self.nodes[c["taxa"][0]] = {"id": {"identifier": c["taxa"][0], "label": tax_name}}
+            for source, results_by_rank in ranked.items():
+                self.annotations.setdefault(source, defaultdict(list))[term] = [r for _, r in sorted(results_by_rank, key=lambda x: x[0])]
+            self.answers[term] = {}
+            for method in METHODS:
+                answer = []
+                for syntype, grouped in results.get(method, {}).items():
+                    if syntype == "unrelated":
+                        continue
+                    for c in grouped:
+                        result = {"synonym": c["label"], "synonymType": syntype}
+                        if method != "label":
+                            result["vocabulary class"] = c.get("biolink_type", "")
+                        answer.append(result)
+                self.answers[term][method] = answer
+
+    def completion(self, prompt):
+        """Replay the recorded answer for whichever kind of ask_* prompt this is, by row number if the prompt is a
+        compact one."""
+        compact = "number of its row" in prompt
+        if "query_terms:\n" in prompt:
+            sections = re.split(r"^\s*(\d+)\. query_term: (.*)$", prompt.split("query_terms:\n", 1)[1], flags=re.MULTILINE)
+            answer = {}
+            for n, term, rows in zip(sections[1::3], sections[2::3], sections[3::3]):
+                recorded = self.answers.get(term.strip(), {})
+                answer[n] = {m: by_row(recorded.get(m, []), rows) for m in METHODS} if compact else recorded
+        else:
+            match = re.search(r"^\s*query_term: (.*)$", prompt, re.MULTILINE)
+            recorded = self.answers.get(match.group(1).strip(), {}) if match else {}
+            if "three separate times" in prompt:
+                answer = {m: by_row(recorded.get(m, []), prompt) for m in METHODS} if compact else recorded
+            elif "possible_synonyms_classes_and_descriptions:" in prompt:
+                answer = recorded.get("class_description", [])
+            elif "possible_synonyms_and_classes:" in prompt:
+                answer = recorded.get("class", [])
+            else:
+                answer = [{"synonym": a["synonym"], "synonymType": a["synonymType"]} for a in recorded.get("label", [])]
+            if compact and not isinstance(answer, dict):
+                answer = by_row(answer, prompt)
+        return "```json\n" + json.dumps(answer, indent=2) + "\n```"
+
+class FakeServices:
+    """NameRes, SAPBERT, NodeNorm and OpenAI stand-ins on one local HTTP server, answering from Fixtures after
+    sleeping latency[service] seconds.  Routes:
+        POST /nameres/annotate, /sapbert/annotate       {"text", "limit"}
+        POST /nameres/reverse_lookup                    {"curies"}
+        POST /nodenorm/get_normalized_nodes             {"curies", ...}
+        POST /openai/v1/chat/completions                OpenAI chat completions"""
+    def __init__(self, fixtures, latency=None, host="127.0.0.1", port=0):
+        self.fixtures = fixtures
+        self.latency = latency if latency is not None else {}
+        self.requests = defaultdict(int)
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                service = self.path.strip("/").split("/")[0]
+                services.requests[service] += 1
+                time.sleep(services.latency.get(service, 0))
+                try:
+                    status, response = services.route(self.path, body)
+                except Exception as e:
+                    status, response = 500, {"error": repr(e)}
+                blob = json.dumps(response).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(blob)))
+                self.end_headers()
+                self.wfile.write(blob)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def route(self, path, body):
+        fixtures = self.fixtures
+        if path == "/nameres/annotate":
+            return 200, fixtures.annotations["NameRes"].get(body["text"], [])[:body.get("limit", 10)]
+        if path == "/sapbert/annotate":
+            return 200, fixtures.annotations["SAPBert"].get(body["text"], [])[:body.get("limit", 10)]
+        if path == "/nameres/reverse_lookup":
+            return 200, {c: fixtures.reverse[c] for c in body["curies"] if c in fixtures.reverse}
+        if path == "/nodenorm/get_normalized_nodes":
+            return 200, {c: fixtures.nodes.get(c) for c in body["curies"]}
+        if path == "/openai/v1/chat/completions":
+            prompt = body["messages"][0]["content"][0]["text"]
+            content = fixtures.completion(prompt)
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            return 200, {"choices": [{"message": {"role": "assistant", "content": content}}], "usage": usage}
+        return 404, {"error": f"no route {path}"}
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class HTTPEngine:
+    """A NER engine backed by the fake NameRes/SAPBERT routes, with the annotate/reverse_lookup interface that bagel
+    uses from NameResNEREngine and SAPBERTNEREngine."""
+    def __init__(self, session, url):
+        self.session = session
+        self.url = url.rstrip("/")
+
+    def annotate(self, term, props=None, limit=10):
+        resp = self.session.post(f"{self.url}/annotate", json={"text": term, "limit": limit})
+        resp.raise_for_status()
+        return resp.json()
+
+    def reverse_lookup(self, curies):
+        resp = self.session.post(f"{self.url}/reverse_lookup", json={"curies": list(curies)})
+        resp.raise_for_status()
+        return resp.json()
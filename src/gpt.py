@@ -1,12 +1,111 @@
 import base64
-import requests
 import os
 import json
+import threading
 from collections import defaultdict
 from pathlib import Path
 from typing import Optional
 
+from candidates import Judgment
+from llm_cache import LLMCache
+from llm_client import AuthError, LLMClient, LLMError, OpenAIBackend, RateLimited, TransientError
+from metrics import metrics
+from prompt_log import get_log
+from prompts import abstract_window, count_tokens, describe, numbered_rows
+
 api_key = os.environ.get("OPENAI_API_KEY")
+model = "gpt-4-0125-preview"
+
+# Built on first use, or by configure_client()
+client = None
+client_lock = threading.Lock()
+
+# Set with use_cache().  BAGEL_LLM_CACHE turns it on from the environment, and BAGEL_LLM_REPLAY=1 makes it read-only.
+cache = None
+if os.environ.get("BAGEL_LLM_CACHE"):
+    cache = LLMCache(os.environ["BAGEL_LLM_CACHE"], replay=os.environ.get("BAGEL_LLM_REPLAY") == "1")
+
+# Responses that still don't fit their schema after max_repairs repair prompts are recorded here
+dead_letter = os.environ.get("BAGEL_DEAD_LETTER", "gpt_dead_letter.jsonl")
+max_repairs = 2
+
+class MalformedResponse(ValueError):
+    """A completion that doesn't hold JSON in the structure its prompt asked for."""
+    pass
+
+LABEL_STRUCTURE = '[ { "synonym": ..., "synonymType": ... } ]'
+CLASS_STRUCTURE = '[ { "synonym": ..., "vocabulary class": ..., "synonymType": ... } ]'
+ALL_STRUCTURE = f'{{ "label": {LABEL_STRUCTURE}, "class": {CLASS_STRUCTURE}, "class_description": {CLASS_STRUCTURE} }}'
+
+# The answer formats asked for in the prompts.  These are exactly the text the prompts have always had (trailing
+# spaces and all), so that uncompacted prompts, and their cache keys, are unchanged.
+LABEL_ANSWER = """[
+        { 
+            "synonym": ...,
+            "synonymType": ...
+        }
+    ]
+    where the value for synonym is the element from the synonym list, and synonymType is either "exact" or "narrow"."""
+CLASS_ANSWER = """[
+        { 
+            "synonym": ...,
+            "vocabulary class": ...,
+            "synonymType": ...
+        }
+    ]
+    where the value for synonym is the element from the synonym list, vocabulary class is the 
+    class that I input associated with that synonym, and synonymType is either "exact" or "narrow"."""
+ALL_ANSWER = """{
+        "label": [ { "synonym": ..., "synonymType": ... } ],
+        "class": [ { "synonym": ..., "vocabulary class": ..., "synonymType": ... } ],
+        "class_description": [ { "synonym": ..., "vocabulary class": ..., "synonymType": ... } ]
+    }
+    where the value for synonym is the element from the synonym list, vocabulary class is the 
+    class that I input associated with that synonym, and synonymType is either "exact" or "narrow"."""
+BATCH_ANSWER = """{
+        "1": {
+            "label": [ { "synonym": ..., "synonymType": ... } ],
+            "class": [ { "synonym": ..., "vocabulary class": ..., "synonymType": ... } ],
+            "class_description": [ { "synonym": ..., "vocabulary class": ..., "synonymType": ... } ]
+        },
+        ...
+    }
+    where the value for synonym is the element from that query term's synonym list, vocabulary class is the 
+    class that I input associated with that synonym, and synonymType is either "exact" or "narrow"."""
+
+# Compact prompts number the possible synonyms and have the answers refer to them by row
+ROW_STRUCTURE = '[ { "synonym": <row number>, "synonymType": ... } ]'
+ROWS_STRUCTURE = f'{{ "label": {ROW_STRUCTURE}, "class": {ROW_STRUCTURE}, "class_description": {ROW_STRUCTURE} }}'
+ROW_ANSWER = f"""{ROW_STRUCTURE}
+    where the value for synonym is the number of its row in the synonym list, and synonymType is either "exact" or "narrow"."""
+ROWS_ANSWER = f"""{ROWS_STRUCTURE}
+    where the value for synonym is the number of its row in the synonym list, and synonymType is either "exact" or "narrow"."""
+BATCH_ROWS_ANSWER = f"""{{ "1": {ROWS_STRUCTURE}, ... }}
+    where the value for synonym is the number of its row in that query term's synonym list, and synonymType is either
+    "exact" or "narrow"."""
+
+# Set with configure_prompts()
+compact_prompts = False
+window_sentences = 1
+description_budget = 48
+
+def configure_prompts(compact=True, context_sentences=1, description_tokens=48):
+    """Turn prompt compaction on or off.  Compact prompts show only the sentences of the abstract within
+    context_sentences of a mention of the query term, list the possible synonyms as numbered rows rather than Python
+    reprs, cut each description to description_tokens, and ask for answers by row number."""
+    global compact_prompts, window_sentences, description_budget
+    compact_prompts = compact
+    window_sentences = context_sentences
+    description_budget = description_tokens
+
+def log_prompt(out_file_path, abstract_id, term, prompt, results):
+    """Append a prompt and its parsed output to the jsonl log at out_file_path."""
+    temp = {}
+    temp['abstract_id'] = abstract_id
+    temp['term'] = term
+    temp['prompt'] = prompt
+    temp['output'] = results
+    get_log(out_file_path).write(temp)
 
 def ask_classes_and_descriptions(text, term, termlist, out_file_path: Optional[str|Path] = None, abstract_id: Optional[int] = None):
     """Get GPT results based only on the labels of the terms."""
@@ -15,9 +114,15 @@ def ask_classes_and_descriptions(text, term, termlist, out_file_path: Optional[s
     labels = defaultdict(list)
     descriptions = defaultdict(list)
     for curie, annotation in termlist.items():
-        labels[(annotation["label"], annotation["biolink_type"])].append(curie)
-        descriptions[(annotation["label"], annotation["biolink_type"])].append(annotation["description"])
+        labels[(annotation.label, annotation.biolink_type)].append(curie)
+        descriptions[(annotation.label, annotation.biolink_type)].append(annotation.description)
     synonym_list = [(x[0], x[1], d) for x, d in descriptions.items()]
+    answer_format = CLASS_ANSWER
+    keys = list(labels.keys())
+    if compact_prompts:
+        text = abstract_window(text, [term], window_sentences)
+        synonym_list = synonym_rows(keys, descriptions)
+        answer_format = ROW_ANSWER
 
     # Define the Prompt
     prompt = f""" You are an expert in biomedical vocabularies and ontologies. I will provide you with the abstract to a scientific paper, as well as
@@ -36,52 +141,27 @@ def ask_classes_and_descriptions(text, term, termlist, out_file_path: Optional[s
     a related synonym of "Pain Disorder".
     It is also possible that there are neither exact nor narrow synonyms of the query term in the list.
     Provide your answers in the following JSON structure:
-    [
-        {{ 
-            "synonym": ...,
-            "vocabulary class": ...,
-            "synonymType": ...
-        }}
-    ]
-    where the value for synonym is the element from the synonym list, vocabulary class is the 
-    class that I input associated with that synonym, and synonymType is either "exact" or "narrow".
+    {answer_format}
 
     abstract: {text}
     query_term: {term}
     possible_synonyms_classes_and_descriptions: {synonym_list}
     """
 
-    results = query(prompt)
+    try:
+        if compact_prompts:
+            results = resolve_rows(query(prompt, check=lambda r: check_judgments(resolve_rows(r, keys, True), labels, with_class=True),
+                                         structure=ROW_STRUCTURE, options=synonym_list, about=term, stage="ask_classes_and_descriptions"), keys, True)
+        else:
+            results = query(prompt, check=lambda r: check_judgments(r, labels, with_class=True),
+                            structure=CLASS_STRUCTURE, options=keys, about=term, stage="ask_classes_and_descriptions")
+    except MalformedResponse:
+        results = []
     
     if out_file_path is not None:
-        temp = {}
-        temp['abstract_id'] = abstract_id
-        temp['term'] = term
-        temp['prompt'] = prompt
-        temp['output'] = results
-        if os.path.isfile(out_file_path):
-            with open(out_file_path, "r") as f:
-                out = json.load(f)
-            out.append(temp)
-        else:
-            out = [temp]
-        with open(out_file_path, "w") as f:
-            json.dump(out, f, indent=4)
+        log_prompt(out_file_path, abstract_id, term, prompt, results)
 
-    for result in results:
-        syn = result['synonym']
-        cls = result['vocabulary class']
-        syntype = result['synonymType']
-        curies = labels[(syn,cls)]
-        for curie in curies:
-            termlist[curie]["synonym_Type"] = syntype
-
-    grouped_by_syntype = defaultdict(list)
-    for curie in termlist:
-        syntype = termlist[curie].get("synonym_Type", "unrelated")
-        termlist[curie]["curie"] = curie
-        grouped_by_syntype[syntype].append(termlist[curie])
-    return grouped_by_syntype
+    return group_by_syntype(termlist, labels, results, lambda result: (result['synonym'], result['vocabulary class']))
 
 
 def ask_classes(text, term, termlist, out_file_path: Optional[str|Path] = None, abstract_id: Optional[int] = None):
@@ -90,8 +170,14 @@ def ask_classes(text, term, termlist, out_file_path: Optional[str|Path] = None,
     # Get the Labels
     labels = defaultdict(list)
     for curie, annotation in termlist.items():
-        labels[(annotation["label"], annotation["biolink_type"])].append(curie)
+        labels[(annotation.label, annotation.biolink_type)].append(curie)
     synonym_list = list(labels.keys())
+    answer_format = CLASS_ANSWER
+    keys = list(labels.keys())
+    if compact_prompts:
+        text = abstract_window(text, [term], window_sentences)
+        synonym_list = synonym_rows(keys)
+        answer_format = ROW_ANSWER
 
     # Define the Prompt
     prompt = f""" You are an expert in biomedical vocabularies and ontologies. I will provide you with the abstract to a scientific paper, as well as
@@ -109,52 +195,27 @@ def ask_classes(text, term, termlist, out_file_path: Optional[str|Path] = None,
     a related synonym of "Pain Disorder".
     It is also possible that there are neither exact nor narrow synonyms of the query term in the list.
     Provide your answers in the following JSON structure:
-    [
-        {{ 
-            "synonym": ...,
-            "vocabulary class": ...,
-            "synonymType": ...
-        }}
-    ]
-    where the value for synonym is the element from the synonym list, vocabulary class is the 
-    class that I input associated with that synonym, and synonymType is either "exact" or "narrow".
+    {answer_format}
 
     abstract: {text}
     query_term: {term}
     possible_synonyms_and_classes: {synonym_list}
     """
 
-    results = query(prompt)
+    try:
+        if compact_prompts:
+            results = resolve_rows(query(prompt, check=lambda r: check_judgments(resolve_rows(r, keys, True), labels, with_class=True),
+                                         structure=ROW_STRUCTURE, options=synonym_list, about=term, stage="ask_classes"), keys, True)
+        else:
+            results = query(prompt, check=lambda r: check_judgments(r, labels, with_class=True),
+                            structure=CLASS_STRUCTURE, options=keys, about=term, stage="ask_classes")
+    except MalformedResponse:
+        results = []
     
     if out_file_path is not None:
-        temp = {}
-        temp['abstract_id'] = abstract_id
-        temp['term'] = term
-        temp['prompt'] = prompt
-        temp['output'] = results
-        if os.path.isfile(out_file_path):
-            with open(out_file_path, "r") as f:
-                out = json.load(f)
-            out.append(temp)
-        else:
-            out = [temp]
-        with open(out_file_path, "w") as f:
-            json.dump(out, f, indent=4)
-
-    for result in results:
-        syn = result['synonym']
-        cls = result['vocabulary class']
-        syntype = result['synonymType']
-        curies = labels[(syn,cls)]
-        for curie in curies:
-            termlist[curie]["synonym_Type"] = syntype
+        log_prompt(out_file_path, abstract_id, term, prompt, results)
 
-    grouped_by_syntype = defaultdict(list)
-    for curie in termlist:
-        syntype = termlist[curie].get("synonym_Type", "unrelated")
-        termlist[curie]["curie"] = curie
-        grouped_by_syntype[syntype].append(termlist[curie])
-    return grouped_by_syntype
+    return group_by_syntype(termlist, labels, results, lambda result: (result['synonym'], result['vocabulary class']))
 
 
 def ask_labels(text, term, termlist, out_file_path: Optional[str|Path] = None, abstract_id: Optional[int] = None):
@@ -163,8 +224,14 @@ def ask_labels(text, term, termlist, out_file_path: Optional[str|Path] = None, a
     # Get the Labels
     labels = defaultdict(list)
     for curie, annotation in termlist.items():
-        labels[annotation["label"]].append(curie)
+        labels[annotation.label].append(curie)
     synonym_list = list(labels.keys())
+    answer_format = LABEL_ANSWER
+    keys = list(labels.keys())
+    if compact_prompts:
+        text = abstract_window(text, [term], window_sentences)
+        synonym_list = synonym_rows(keys)
+        answer_format = ROW_ANSWER
 
     # Define the Prompt
     prompt = f""" You are an expert in biomedical vocabularies and ontologies. I will provide you with the abstract to a scientific paper, as well as
@@ -179,73 +246,413 @@ def ask_labels(text, term, termlist, out_file_path: Optional[str|Path] = None, a
     a related synonym of "Pain Disorder".
     It is also possible that there are neither exact nor narrow synonyms of the query term in the list.
     Provide your answers in the following JSON structure:
-    [
-        {{ 
-            "synonym": ...,
-            "synonymType": ...
-        }}
-    ]
-    where the value for synonym is the element from the synonym list, and synonymType is either "exact" or "narrow".
+    {answer_format}
                         
     abstract: {text}
     query_term: {term}
     possible_synonyms: {synonym_list}
     """
 
-    results = query(prompt)
+    try:
+        if compact_prompts:
+            results = resolve_rows(query(prompt, check=lambda r: check_judgments(resolve_rows(r, keys), labels),
+                                         structure=ROW_STRUCTURE, options=synonym_list, about=term, stage="ask_labels"), keys)
+        else:
+            results = query(prompt, check=lambda r: check_judgments(r, labels), structure=LABEL_STRUCTURE,
+                            options=keys, about=term, stage="ask_labels")
+    except MalformedResponse:
+        results = []
     
     if out_file_path is not None:
-        temp = {}
-        temp['abstract_id'] = abstract_id
-        temp['term'] = term
-        temp['prompt'] = prompt
-        temp['output'] = results
-        if os.path.isfile(out_file_path):
-            with open(out_file_path, "r") as f:
-                out = json.load(f)
-            out.append(temp)
-        else:
-            out = [temp]
-        with open(out_file_path, "w") as f:
-            json.dump(out, f, indent=4)
+        log_prompt(out_file_path, abstract_id, term, prompt, results)
 
+    return group_by_syntype(termlist, labels, results, lambda result: result['synonym'])
+
+def group_by_syntype(termlist, labels, results, key):
+    """Group the candidates in termlist by the synonymType GPT gave them, as Judgments.  The candidates themselves
+    are left alone, so the other judgments of the same term can share them.  labels maps the prompt's synonym keys to
+    curies, and key pulls the same kind of key out of a result."""
+    syntypes = {}
     for result in results:
-        syn = result['synonym']
         syntype = result['synonymType']
-        curies = labels[syn]
+        curies = labels[key(result)]
         for curie in curies:
-            termlist[curie]["synonym_Type"] = syntype
+            syntypes[curie] = syntype
 
     grouped_by_syntype = defaultdict(list)
     for curie in termlist:
-        syntype = termlist[curie].get("synonym_Type","unrelated")
-        termlist[curie]["curie"] = curie
-        grouped_by_syntype[syntype].append(termlist[curie])
+        syntype = syntypes.get(curie, "unrelated")
+        grouped_by_syntype[syntype].append(Judgment(termlist[curie], syntype))
     return grouped_by_syntype
 
-def query(prompt):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+def ask_all(text, term, termlist, out_file_path: Optional[str|Path] = None, abstract_id: Optional[int] = None):
+    """Get the label, class and class+description judgments from a single GPT call.  Returns a dict with keys
+    "label", "class" and "class_description", each grouped by synonym type the way the corresponding ask_* would."""
+
+    labels, classes, synonym_list = all_synonyms(termlist)
+    answer_format = ALL_ANSWER
+    keys = list(classes.keys())
+    if compact_prompts:
+        text = abstract_window(text, [term], window_sentences)
+        synonym_list = synonym_rows(keys, {(label, cls): d for label, cls, d in synonym_list})
+        answer_format = ROWS_ANSWER
+
+    # Define the Prompt
+    prompt = f""" You are an expert in biomedical vocabularies and ontologies. I will provide you with the abstract to a scientific paper, as well as
+    a query term: biomedical entity that occurs in that abstract.  I will also provide you a list of possible synonyms for the query term, along
+    with their class as defined within their vocabulary, such as Gene or Disease, and for some entities a description of the entity.
+    Please determine whether the query term, as it is used in the abstract, is an exact synonym of any of the terms in the list.  There should be at most one
+    exact synonym of the query term.  If there are no exact synonyms for the query term in the list, please look for narrow, broad, or related synonyms, 
+    The synonym is narrow if the query term is a more specific form of one of the list terms. For example, the query term "Type 2 Diabetes" would be a 
+    narrow synonym of "Diabetes" because it is not an exact synonym, but a more specific form. 
+    The synonym is broad if the query term is a more general form of the list term.  For instance, the query term "brain injury" would be a broad synonym
+    of "Cerebellar Injury" because it is more generic.
+    The synonym is related if it is neither exact, narrow, or broad, but is still a similar enough term.  For instance the query term "Pain" would be
+    a related synonym of "Pain Disorder".
+    It is also possible that there are neither exact nor narrow synonyms of the query term in the list.
+    Make this determination three separate times:
+    "label": using only the names of the possible synonyms, ignoring their classes and descriptions.
+    "class": using the names and classes, but not the descriptions.  The class will help you distinguish between
+    entities with the same name such as HIV, which could refer to either a particular virus (class OrganismTaxon) or a disease (class Disease). It can also
+    help distinguish between a disease hyperlipidemia (class Disease) versus hyperlipidemia as a symptom of another disease (class PhenotpyicFeature).
+    "class_description": using the names, classes and descriptions.
+    Provide your answers in the following JSON structure:
+    {answer_format}
 
-    payload = {
-        "model": "gpt-4-0125-preview",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
+    abstract: {text}
+    query_term: {term}
+    possible_synonyms_classes_and_descriptions: {synonym_list}
+    """
+
+    try:
+        if compact_prompts:
+            results = resolve_all(query(prompt, shape="{}", check=lambda r: check_all(resolve_all(r, keys), labels, classes),
+                                        structure=ROWS_STRUCTURE, options=synonym_list, about=term, stage="ask_all"), keys)
+        else:
+            results = query(prompt, shape="{}", check=lambda r: check_all(r, labels, classes), structure=ALL_STRUCTURE,
+                            options=keys, about=term, stage="ask_all")
+    except MalformedResponse:
+        results = {}
+
+    if out_file_path is not None:
+        log_prompt(out_file_path, abstract_id, term, prompt, results)
+
+    return group_all(termlist, labels, classes, results)
+
+def all_synonyms(termlist):
+    """The lookups and synonym list that ask_all needs: curies by label, curies by (label, class), and the
+    (label, class, descriptions) list shown to GPT."""
+    labels = defaultdict(list)
+    classes = defaultdict(list)
+    descriptions = defaultdict(list)
+    for curie, annotation in termlist.items():
+        labels[annotation.label].append(curie)
+        classes[(annotation.label, annotation.biolink_type)].append(curie)
+        descriptions[(annotation.label, annotation.biolink_type)].append(annotation.description)
+    synonym_list = [(x[0], x[1], d) for x, d in descriptions.items()]
+    return labels, classes, synonym_list
+
+def group_all(termlist, labels, classes, results):
+    """Turn a {"label": [...], "class": [...], "class_description": [...]} response into the three grouped_by_syntype
+    dicts, all three sharing termlist's candidates."""
+    return {
+        "label": group_by_syntype(termlist, labels, results.get("label", []), lambda result: result['synonym']),
+        "class": group_by_syntype(termlist, classes, results.get("class", []), lambda result: (result['synonym'], result['vocabulary class'])),
+        "class_description": group_by_syntype(termlist, classes, results.get("class_description", []), lambda result: (result['synonym'], result['vocabulary class']))
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    content = response.json()["choices"][0]["message"]["content"]
-    chunk = content[content.index("["):(content.rindex("]")+1)]
-    output = json.loads(chunk)
+def batch_synonyms(termlist):
+    """all_synonyms(termlist), the (label, class) keys, and the synonym list as ask_batch shows it: compact rows if
+    compact_prompts is set."""
+    synonyms = all_synonyms(termlist)
+    keys = list(synonyms[1].keys())
+    if compact_prompts:
+        return synonyms, keys, synonym_rows(keys, {(label, cls): d for label, cls, d in synonyms[2]})
+    return synonyms, keys, synonyms[2]
+
+def batch_abstract(text, terms):
+    """The abstract as ask_batch shows it for terms: just the window around them if compact_prompts is set."""
+    return abstract_window(text, terms, window_sentences) if compact_prompts else text
+
+def batch_query_term(i, term, shown):
+    """The i-th (from 0) query term of an ask_batch prompt."""
+    return f"    {i+1}. query_term: {term}\n       possible_synonyms_classes_and_descriptions: {shown}"
+
+def batch_terms(text, term_sets, token_budget=6000):
+    """Split {term: termlist} into batches for ask_batch.  Each batch's prompt (abstract plus candidate lists, counted
+    as ask_batch will send them) is kept under token_budget, except that a single term is always allowed a batch of its
+    own."""
+    batches = []
+    batch = {}
+    used = 0
+    for term, termlist in term_sets.items():
+        shown = batch_synonyms(termlist)[2]
+        cost = count_tokens(batch_query_term(len(batch), term, shown))
+        if len(batch) > 0 and count_tokens(batch_abstract(text, list(batch) + [term])) + used + cost > token_budget:
+            batches.append(batch)
+            batch = {}
+            used = 0
+            cost = count_tokens(batch_query_term(0, term, shown))
+        batch[term] = termlist
+        used += cost
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+def ask_batch(text, term_sets, out_file_path: Optional[str|Path] = None, abstract_id: Optional[int] = None):
+    """ask_all for several terms of the same abstract in one GPT call.  term_sets is {term: termlist}; returns
+    {term: ask_all-style result}.  Terms whose part of the response is missing are retried one at a time with
+    ask_all, and parts that don't check are sent for repair on their own."""
+    terms = list(term_sets.keys())
+    synonyms, keys, shown = {}, {}, {}
+    for term in terms:
+        synonyms[term], keys[term], shown[term] = batch_synonyms(term_sets[term])
+    abstract = batch_abstract(text, terms)
+    answer_format = BATCH_ROWS_ANSWER if compact_prompts else BATCH_ANSWER
+    query_terms = "\n".join(batch_query_term(i, term, shown[term]) for i, term in enumerate(terms))
+
+    # Define the Prompt
+    prompt = f""" You are an expert in biomedical vocabularies and ontologies. I will provide you with the abstract to a scientific paper, as well as
+    a numbered list of query terms: biomedical entities that occur in that abstract.  For each query term I will also provide a list of possible synonyms,
+    along with their class as defined within their vocabulary, such as Gene or Disease, and for some entities a description of the entity.
+    For each query term, please determine whether the query term, as it is used in the abstract, is an exact synonym of any of the terms in its list.
+    There should be at most one exact synonym of each query term.  If there are no exact synonyms for the query term in the list, please look for
+    narrow, broad, or related synonyms, 
+    The synonym is narrow if the query term is a more specific form of one of the list terms. For example, the query term "Type 2 Diabetes" would be a 
+    narrow synonym of "Diabetes" because it is not an exact synonym, but a more specific form. 
+    The synonym is broad if the query term is a more general form of the list term.  For instance, the query term "brain injury" would be a broad synonym
+    of "Cerebellar Injury" because it is more generic.
+    The synonym is related if it is neither exact, narrow, or broad, but is still a similar enough term.  For instance the query term "Pain" would be
+    a related synonym of "Pain Disorder".
+    It is also possible that there are neither exact nor narrow synonyms of the query term in the list.
+    Make this determination three separate times for each query term:
+    "label": using only the names of the possible synonyms, ignoring their classes and descriptions.
+    "class": using the names and classes, but not the descriptions.  The class will help you distinguish between
+    entities with the same name such as HIV, which could refer to either a particular virus (class OrganismTaxon) or a disease (class Disease). It can also
+    help distinguish between a disease hyperlipidemia (class Disease) versus hyperlipidemia as a symptom of another disease (class PhenotpyicFeature).
+    "class_description": using the names, classes and descriptions.
+    Provide your answers in the following JSON structure, keyed by the number of the query term:
+    {answer_format}
+
+    abstract: {abstract}
+    query_terms:
+{query_terms}
+    """
+
+    try:
+        # A batch response that doesn't parse isn't repaired: there's no one list of synonyms to repair it against,
+        # and each term is asked on its own below anyway
+        results = query(prompt, shape="{}", check=check_object, about=terms, repairs=0, stage="ask_batch")
+    except MalformedResponse as e:
+        print("Batched response did not parse, falling back to one call per term:", e)
+        results = {}
+
+    if out_file_path is not None:
+        log_prompt(out_file_path, abstract_id, terms, prompt, results)
+
+    resolved = {}
+    for i, term in enumerate(terms):
+        labels, classes, _ = synonyms[term]
+        term_results = results.get(str(i+1))
+        if term_results is None:
+            resolved[term] = ask_all(text, term, term_sets[term], out_file_path=out_file_path, abstract_id=abstract_id)
+            continue
+        # Only this term's part of the response goes back for repair
+        if compact_prompts:
+            check = lambda r, term=term, labels=labels, classes=classes: check_all(resolve_all(r, keys[term]), labels, classes)
+        else:
+            check = lambda r, labels=labels, classes=classes: check_all(r, labels, classes)
+        try:
+            check(term_results)
+        except MalformedResponse as e:
+            metrics.count("malformed", service="LLM")
+            try:
+                term_results, _ = repair(prompt, json.dumps(term_results), e, "{}", check,
+                                         ROWS_STRUCTURE if compact_prompts else ALL_STRUCTURE, shown[term] if compact_prompts else keys[term], term)
+            except MalformedResponse:
+                term_results = {}
+        if compact_prompts:
+            term_results = resolve_all(term_results, keys[term])
+        resolved[term] = group_all(term_sets[term], labels, classes, term_results)
+    return resolved
+
+def use_cache(path="llm_cache.sqlite", replay=False, max_entries=100000, max_age=None):
+    """Cache (or, with replay=True, only replay) query responses on disk."""
+    global cache
+    cache = LLMCache(path, max_entries=max_entries, max_age=max_age, replay=replay)
+    return cache
+
+def query(prompt, shape="[]", check=None, structure=None, options=None, about=None, repairs=None, stage=None):
+    """Send the prompt and parse the JSON in the response.  shape gives the delimiters of the outermost JSON value:
+    "[]" for a list, "{}" for an object; objects are requested in JSON mode.  check raises MalformedResponse for
+    output that doesn't fit the schema the prompt asked for.  A response that doesn't parse or check is sent back
+    for repair (see repair()) up to repairs times (by default max_repairs), and only responses that end up valid are
+    cached.  Raises MalformedResponse if it
+    can't be repaired, or if the service rejects this prompt outright (a 4xx, or no completion); both are recorded
+    in the dead_letter log.  Auth errors, and rate limits and outages that outlast the client's retries, are raised
+    as they are, since every other prompt would fail the same way.  The tokens of each call are recorded under stage,
+    the ask_* function making it."""
+    content = None
+    if cache is not None:
+        content = cache.get(model, prompt)
+        metrics.count("llm_cache.hit" if content is not None else "llm_cache.miss")
+    fresh = content is None
+    if fresh:
+        try:
+            content = complete(prompt, json_mode=shape == "{}", stage=stage)
+        except (AuthError, RateLimited, TransientError):
+            # Not this prompt's fault: the service is refusing us or is down even after retries
+            raise
+        except LLMError as e:
+            # This prompt was rejected (a 4xx such as context_length_exceeded, or no completion in the response)
+            metrics.count("rejected", service="LLM")
+            dead_letter_write(about, str(e), prompt, [])
+            raise MalformedResponse(f"request rejected: {e}")
+    try:
+        output = parse_response(content, shape, check)
+    except MalformedResponse as e:
+        metrics.count("malformed", service="LLM")
+        output, content = repair(prompt, content, e, shape, check, structure, options, about, repairs, stage)
+        fresh = True
+    if fresh and cache is not None:
+        cache.put(model, prompt, content)
     return output
+
+def parse_response(content, shape, check=None):
+    try:
+        chunk = content[content.index(shape[0]):(content.rindex(shape[1])+1)]
+        output = json.loads(chunk)
+    except ValueError as e:
+        raise MalformedResponse(f"no JSON {shape[0]}...{shape[1]} value in the response ({e})")
+    if check is not None:
+        check(output)
+    return output
+
+def check_object(results):
+    if not isinstance(results, dict):
+        raise MalformedResponse(f"expected a JSON object, got {type(results).__name__}")
+
+def check_judgments(results, synonyms, with_class=False):
+    """Raise MalformedResponse unless results is a list of judgments that each name one of synonyms (the labels, or
+    (label, class) pairs if with_class, that were offered in the prompt)."""
+    if not isinstance(results, list):
+        raise MalformedResponse(f"expected a JSON list, got {type(results).__name__}")
+    for result in results:
+        if not isinstance(result, dict) or not isinstance(result.get("synonym"), str) or not isinstance(result.get("synonymType"), str):
+            raise MalformedResponse(f"each judgment needs a synonym and a synonymType: {json.dumps(result)}")
+        if with_class and not isinstance(result.get("vocabulary class", 0), (str, type(None))):
+            raise MalformedResponse(f"each judgment needs a vocabulary class: {json.dumps(result)}")
+        key = (result["synonym"], result["vocabulary class"]) if with_class else result["synonym"]
+        if key not in synonyms:
+            raise MalformedResponse(f"not one of the possible synonyms: {json.dumps(result)}")
+
+def synonym_rows(keys, descriptions=None):
+    """The compact form of a synonym list: keys (labels, or (label, class) pairs) as numbered rows, with their
+    descriptions, cut to description_budget tokens each, if descriptions ({key: [description]}) is given."""
+    rows = []
+    for key in keys:
+        row = key if isinstance(key, tuple) else (key,)
+        if descriptions is not None:
+            row = row + (describe(descriptions[key], description_budget),)
+        rows.append(row)
+    return "\n" + numbered_rows(rows)
+
+def resolve_rows(results, keys, with_class=False):
+    """Turn answers that give synonyms by row number back into the named form that check_judgments and
+    group_by_syntype expect.  keys[n-1] is the label or (label, class) of row n."""
+    if not isinstance(results, list):
+        raise MalformedResponse(f"expected a JSON list, got {type(results).__name__}")
+    named = []
+    for result in results:
+        row = result.get("synonym") if isinstance(result, dict) else None
+        if isinstance(row, str) and row.strip().isdigit():
+            row = int(row)
+        if not isinstance(row, int) or not 1 <= row <= len(keys):
+            raise MalformedResponse(f"synonym should be a row number from 1 to {len(keys)}: {json.dumps(result)}")
+        label, cls = keys[row-1] if isinstance(keys[row-1], tuple) else (keys[row-1], None)
+        result = dict(result, synonym=label)
+        if with_class:
+            result["vocabulary class"] = cls
+        named.append(result)
+    return named
+
+def resolve_all(results, keys):
+    """resolve_rows for each of the three parts of a compact ask_all response."""
+    check_object(results)
+    return {"label": resolve_rows(results.get("label", []), keys),
+            "class": resolve_rows(results.get("class", []), keys, with_class=True),
+            "class_description": resolve_rows(results.get("class_description", []), keys, with_class=True)}
+
+def check_all(results, labels, classes):
+    """check_judgments for each of the three parts of an ask_all response."""
+    check_object(results)
+    check_judgments(results.get("label", []), labels)
+    check_judgments(results.get("class", []), classes, with_class=True)
+    check_judgments(results.get("class_description", []), classes, with_class=True)
+
+def repair(prompt, content, error, shape, check, structure, options, about=None, repairs=None, stage=None):
+    """Ask for a corrected version of a malformed response.  The repair prompt carries only the bad response, what
+    was wrong with it, the structure wanted and the synonyms it may name, not the abstract and the rest of the
+    original prompt.  Returns (output, repaired content).  After repairs (by default max_repairs) failed attempts, or
+    straight away when replaying from the cache, the failure is written to dead_letter and MalformedResponse is
+    raised."""
+    responses = [content]
+    attempts = max_repairs if repairs is None else repairs
+    if cache is not None and cache.replay:
+        attempts = 0
+    for _ in range(attempts):
+        metrics.count("repairs", service="LLM")
+        repair_prompt = f""" Your previous response could not be used: {error}
+    Your previous response was:
+    {content}
+    Please reply with only the corrected JSON, in the following structure:
+    {structure}
+    where each synonym (and vocabulary class, if present) is copied exactly from this list of possible synonyms, or is
+    its row number if the rows are numbered:
+    {options}
+    """
+        # Repairs go to the front of the queue, since an abstract is waiting on them
+        try:
+            content = complete(repair_prompt, priority=-1, json_mode=shape == "{}",
+                               stage=f"{stage}.repair" if stage is not None else "repair")
+        except (AuthError, RateLimited, TransientError):
+            raise
+        except LLMError as e:
+            error = MalformedResponse(f"repair rejected: {e}")
+            break
+        responses.append(content)
+        try:
+            return parse_response(content, shape, check), content
+        except MalformedResponse as e:
+            error = e
+    print(f"Giving up on the response for {about}: {error}")
+    dead_letter_write(about, str(error), prompt, responses)
+    raise error
+
+def dead_letter_write(about, error, prompt, responses):
+    """Record a prompt that couldn't be answered in the dead_letter log, so it can be looked at or rerun."""
+    metrics.count("dead_letters", service="LLM")
+    log = get_log(dead_letter)
+    log.write({"about": about, "error": error, "prompt": prompt, "responses": responses})
+    log.flush()
+
+def configure_client(base_url=None, rpm=500, tpm=300000, workers=8, backend=None):
+    """Replace the LLM client.  base_url (or OPENAI_BASE_URL) points the OpenAI backend somewhere else, such as a
+    local stub server; backend replaces it outright."""
+    global client
+    if backend is None:
+        backend = OpenAIBackend(api_key, base_url=base_url or os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"), pool_size=workers)
+    client = LLMClient(backend, model, rpm=rpm, tpm=tpm, workers=workers)
+    return client
+
+def get_client():
+    with client_lock:
+        if client is None:
+            configure_client()
+        return client
+
+def complete(prompt, priority=0, json_mode=False, stage=None):
+    """Send the prompt to the LLM and return the raw text of the completion.  Its token usage is recorded for stage."""
+    response = get_client().complete(prompt, priority=priority, json_mode=json_mode)
+    metrics.observe_tokens(stage or "", response.usage.get("prompt_tokens", 0), response.usage.get("completion_tokens", 0))
+    return response.content
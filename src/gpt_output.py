@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+def iter_json_array(inf, chunk_size=1 << 20):
+    """Yield the elements of the JSON array in the open text file inf one at a time, reading chunk_size characters
+    at a time, so memory is bounded by the largest element rather than the whole file."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    eof = False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = inf.read(chunk_size)
+        if chunk == "":
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    skip(" \t\r\n")
+    if pos >= len(buf) or buf[pos] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+    while True:
+        skip(" \t\r\n,")
+        if pos >= len(buf):
+            raise ValueError("Unterminated JSON array")
+        if buf[pos] == "]":
+            return
+        while True:
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+                # A number cut off by the end of the buffer (as "12" of "123", or "3" of "3.25") may continue in the
+                # next chunk, so only accept an element once the delimiter after it has been read
+                if eof or (end < len(buf) and buf[end] in ",] \t\r\n"):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+        pos = end
+        yield element
+
+def parse_datum(datum):
+    """Turn one element of a GPT output file into a parsed paper.  Returns (paper, errors), where errors lists the
+    Core Triples lines that couldn't be turned into entities."""
+    outthing = {}
+    for line in datum["prompt"].split("\n"):
+        if line.startswith("Title: "):
+            outthing["title"] = line[len("Title: "):]
+        if line.startswith("Abstract: "):
+            outthing["abstract"] = line[len("Abstract: "):]
+    outthing["abstract_id"] = datum["abstract_id"]
+    outthing["entities"] = []
+    errors = []
+    intrips = False
+    for line in datum["output"].split("\n"):
+        if intrips:
+            if line.strip() in ("", "```", "```json"):
+                continue
+            try:
+                start = line.index("{")
+                end = line.rindex("}")
+                triple = json.loads(line[start:end+1])
+                entities = [{"entity": triple["subject"], "qualifier": triple["subject_qualifier"]},
+                            {"entity": triple["object"], "qualifier": triple["object_qualifier"]}]
+            except (ValueError, KeyError, TypeError) as e:
+                errors.append({"abstract_id": datum["abstract_id"], "line": line, "error": repr(e)})
+                continue
+            outthing["entities"].extend(entities)
+        elif line.startswith("Core Triples"):
+            intrips = True
+    return outthing, errors
+
+def parse_file(fname, outname, errname):
+    """Parse one GPT output file into jsonl at outname, writing unparseable lines to errname.  Returns the number
+    of papers and errors."""
+    npapers = 0
+    nerrors = 0
+    with open(fname, "r") as inf, open(outname, "w") as outf, open(errname, "w") as errf:
+        for datum in iter_json_array(inf):
+            try:
+                outthing, errors = parse_datum(datum)
+            except (KeyError, TypeError, AttributeError) as e:
+                errors = [{"abstract_id": datum.get("abstract_id") if isinstance(datum, dict) else None, "line": None, "error": repr(e)}]
+                outthing = None
+            for error in errors:
+                error["file"] = fname
+                errf.write(json.dumps(error)+"\n")
+            nerrors += len(errors)
+            if outthing is not None:
+                outf.write(json.dumps(outthing)+"\n")
+                npapers += 1
+    return npapers, nerrors
+
+def parse_files(fnames, outfile, errfile, workers=None):
+    """Parse several GPT output files in parallel worker processes and concatenate the results, in the order of
+    fnames, into outfile and errfile."""
+    parts = [(f"{outfile}.part{i}", f"{errfile}.part{i}") for i in range(len(fnames))]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        counts = list(pool.map(parse_file, fnames, [p[0] for p in parts], [p[1] for p in parts]))
+    for target, index in ((outfile, 0), (errfile, 1)):
+        with open(target, "w") as outf:
+            for part in parts:
+                with open(part[index], "r") as inf:
+                    shutil.copyfileobj(inf, outf)
+                os.remove(part[index])
+    for fname, (npapers, nerrors) in zip(fnames, counts):
+        print(f"{fname}: {npapers} papers, {nerrors} unparseable lines")
+    return counts
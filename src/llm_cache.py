@@ -0,0 +1,32 @@
+import hashlib
+
+from sqlite_cache import SQLiteCache
+
+class ReplayMiss(KeyError):
+    """Raised in replay mode when a prompt has no recorded response."""
+    pass
+
+class LLMCache(SQLiteCache):
+    """On-disk cache of LLM completions, keyed by a hash of the model and prompt.  In replay mode the cache is
+    read-only, and a miss raises ReplayMiss instead of letting the caller go to the network."""
+    table = "responses"
+    columns = ("model", "prompt", "response")
+
+    def __init__(self, path="llm_cache.sqlite", max_entries=100000, max_age=None, replay=False):
+        super().__init__(path, max_entries=max_entries, max_age=max_age, read_only=replay)
+        self.replay = replay
+
+    @staticmethod
+    def key(model, prompt):
+        return hashlib.sha256(f"{model}\n{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, model, prompt):
+        """Return the cached response for (model, prompt), or None on a miss."""
+        key = self.key(model, prompt)
+        response = self.lookup(key, "response")
+        if response is None and self.replay:
+            raise ReplayMiss(key)
+        return response
+
+    def put(self, model, prompt, response):
+        self.store(self.key(model, prompt), (model, prompt, response))
@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import random
+import re
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+class LLMError(Exception):
+    """The LLM service returned something other than a completion."""
+    pass
+
+class RateLimited(LLMError):
+    """The LLM service asked us to slow down.  retry_after is how long it asked us to wait, if it said."""
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class TransientError(LLMError):
+    """A failure worth retrying: a timeout, a dropped connection or a 5xx."""
+    pass
+
+class AuthError(LLMError):
+    """The service refused our credentials or configuration (401/403), so every request will fail the same way."""
+    pass
+
+class LLMResponse:
+    def __init__(self, content, usage=None, headers=None):
+        self.content = content
+        self.usage = usage if usage is not None else {}
+        self.headers = headers if headers is not None else {}
+
+def parse_duration(value):
+    """Seconds in a rate-limit header value such as "20ms", "1s" or "6m0s".  Returns None if it can't be read."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if len(parts) == 0:
+        return None
+    return sum(float(n) * units[u] for n, u in parts)
+
+class OpenAIBackend:
+    """Chat completions over HTTP.  base_url can point at anything that speaks the OpenAI API, such as a local stub
+    server in tests."""
+    def __init__(self, api_key, base_url="https://api.openai.com/v1", pool_size=10, timeout=120):
+        self.api_key = api_key
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def complete(self, model, prompt, json_mode=False):
+        """json_mode asks for a response that is a single JSON object (the prompt has to mention JSON)."""
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.api_key}"
+        }
+
+        payload = {
+            "model": model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ]
+                }
+            ]
+        }
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+
+        try:
+            response = self.session.post(self.url, headers=headers, json=payload, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TransientError(repr(e))
+        if response.status_code == 429:
+            retry_after = parse_duration(response.headers.get("retry-after"))
+            raise RateLimited(f"429: {response.text[:200]}", retry_after=retry_after)
+        if response.status_code >= 500:
+            raise TransientError(f"{response.status_code}: {response.text[:200]}")
+        if response.status_code in (401, 403):
+            raise AuthError(f"{response.status_code}: {response.text[:200]}")
+        if response.status_code >= 400:
+            raise LLMError(f"{response.status_code}: {response.text[:200]}")
+        try:
+            body = response.json()
+            content = body["choices"][0]["message"]["content"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            raise LLMError(f"{response.status_code}: no completion in response: {response.text[:200]}")
+        return LLMResponse(content, body.get("usage", {}), dict(response.headers))
+
+class TokenBucket:
+    """Allows capacity units per minute, refilled continuously.  pause() stops all acquisitions until a given time."""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount):
+        # Never ask for more than the bucket can hold, or we'd wait forever
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.level >= amount:
+                    self.level -= amount
+                    return
+                wait = max(self.paused_until - now, (amount - self.level) / self.rate)
+            time.sleep(min(wait, 1.0))
+
+    def adjust(self, amount):
+        """Charge (or, if negative, refund) amount, e.g. once the real token usage of a request is known."""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level - amount)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+class LLMClient:
+    """Schedules completions against a backend within requests-per-minute and tokens-per-minute budgets.
+
+    Requests wait in a priority queue (lower numbers first, FIFO within a priority) and are sent by a fixed number
+    of worker threads.  Rate-limit headers on each response pause the budgets until the service's reset time when
+    they run out, and 429s and transient errors are retried with exponential backoff."""
+    def __init__(self, backend, model, rpm=500, tpm=300000, workers=8, max_retries=6, completion_tokens=500,
+                 backoff=1.0, max_backoff=60.0):
+        self.backend = backend
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.completion_tokens = completion_tokens
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = []
+        self.counter = itertools.count()
+        self.cv = threading.Condition()
+        self.closed = False
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, prompt, priority=0, json_mode=False):
+        """Queue a prompt and return a Future for its LLMResponse."""
+        future = Future()
+        with self.cv:
+            if self.closed:
+                raise RuntimeError("LLMClient is closed")
+            heapq.heappush(self.queue, (priority, next(self.counter), prompt, json_mode, future))
+            self.cv.notify()
+        return future
+
+    def complete(self, prompt, priority=0, json_mode=False):
+        """Send a prompt and wait for its LLMResponse."""
+        return self.submit(prompt, priority, json_mode).result()
+
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        while True:
+            with self.cv:
+                while len(self.queue) == 0 and not self.closed:
+                    self.cv.wait()
+                if len(self.queue) == 0:
+                    return
+                _, _, prompt, json_mode, future = heapq.heappop(self.queue)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self._send(prompt, json_mode))
+            except Exception as e:
+                future.set_exception(e)
+
+    def _send(self, prompt, json_mode=False):
+        estimate = len(prompt) // 4 + self.completion_tokens
+        for attempt in range(self.max_retries + 1):
+            self.requests.acquire(1)
+            self.tokens.acquire(estimate)
+            try:
+                with metrics.timer("complete", "LLM"):
+                    response = self.backend.complete(self.model, prompt, json_mode=json_mode)
+            except RateLimited as e:
+                metrics.count("rate_limited", service="LLM")
+                if attempt == self.max_retries:
+                    raise
+                metrics.count("retries", service="LLM")
+                wait = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                print(f"Rate limited, pausing {wait:.1f}s")
+                self.requests.pause(wait)
+                self.tokens.pause(wait)
+                continue
+            except TransientError as e:
+                if attempt == self.max_retries:
+                    raise
+                metrics.count("retries", service="LLM")
+                wait = self._backoff(attempt)
+                print(f"LLM call failed ({e}), retrying in {wait:.1f}s")
+                time.sleep(wait)
+                continue
+            self._observe(response, estimate)
+            return response
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def _observe(self, response, estimate):
+        """Reconcile the token budget with the real usage, and pause when the service says a budget is spent."""
+        metrics.count("prompt_tokens", response.usage.get("prompt_tokens", 0), service="LLM")
+        metrics.count("completion_tokens", response.usage.get("completion_tokens", 0), service="LLM")
+        used = response.usage.get("total_tokens")
+        if used is not None:
+            self.tokens.adjust(used - estimate)
+        headers = {k.lower(): v for k, v in response.headers.items()}
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            wait = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if wait is not None:
+                self.requests.pause(wait)
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and remaining_tokens.isdigit() and int(remaining_tokens) < self.completion_tokens:
+            wait = parse_duration(headers.get("x-ratelimit-reset-tokens"))
+            if wait is not None:
+                self.tokens.pause(wait)
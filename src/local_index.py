@@ -0,0 +1,100 @@
+import json
+import sqlite3
+import sys
+import threading
+
+from term_cache import normalize_term
+
+class LocalCandidateIndex:
+    """Offline candidate generation over a synonyms dump, usable in place of NameResNEREngine and SAPBERTNEREngine.
+
+    Names are held in a SQLite FTS5 trigram index, so lookups are fuzzy substring matches ranked by BM25, with exact
+    (normalized) name matches ranked first.  The database is opened memory-mapped and read-only, and can be shared
+    between threads and processes.  Build it with build_index()."""
+    def __init__(self, path, mmap_size=1 << 30):
+        self.path = path
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.conn.execute(f"PRAGMA mmap_size = {int(mmap_size)}")
+        self.lock = threading.Lock()
+
+    def annotate(self, term, props=None, limit=10):
+        """Return up to limit candidates for term as [{"id", "label", "score", "biolink_type"}], best first."""
+        key = normalize_term(term)
+        exact = set()
+        scores = {}
+        with self.lock:
+            for (concept_id,) in self.conn.execute("SELECT concept_id FROM exact_names WHERE name = ?", (key,)):
+                exact.add(concept_id)
+                scores[concept_id] = 0.0
+            trigrams = list(dict.fromkeys(key[i:i+3] for i in range(len(key) - 2)))
+            if len(trigrams) > 0:
+                match = " OR ".join('"' + t.replace('"', '""') + '"' for t in trigrams)
+                rows = self.conn.execute("""SELECT concept_id, -bm25(names) FROM names WHERE names MATCH ?
+                                            ORDER BY bm25(names) LIMIT ?""", (match, limit * 20))
+                for concept_id, score in rows:
+                    scores[concept_id] = max(score, scores.get(concept_id, score))
+            # Exact name matches first, then by BM25
+            best = sorted(scores, key=lambda c: (c in exact, scores[c]), reverse=True)[:limit]
+            results = []
+            for concept_id in best:
+                curie, label, biolink_type = self.conn.execute(
+                    "SELECT curie, label, biolink_type FROM concepts WHERE id = ?", (concept_id,)).fetchone()
+                results.append({"id": curie, "label": label, "score": scores[concept_id], "biolink_type": biolink_type})
+        return results
+
+    def reverse_lookup(self, curies):
+        """The same {curie: {"label", "biolink_type", "taxa", "clique_identifier_count"}} that NameRes returns."""
+        results = {}
+        with self.lock:
+            for curie in curies:
+                row = self.conn.execute("""SELECT label, biolink_type, taxa, clique_identifier_count FROM concepts
+                                           WHERE curie = ?""", (curie,)).fetchone()
+                if row is not None:
+                    results[curie] = {"label": row[0], "biolink_type": row[1], "taxa": json.loads(row[2]),
+                                      "clique_identifier_count": row[3]}
+        return results
+
+def build_index(synonyms_files, path, batch_size=10000):
+    """Build an index at path from NameRes/Babel synonym dumps: jsonl with one clique per line, holding "curie",
+    "names", and optionally "preferred_name", "types", "taxa" and "clique_identifier_count"."""
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        DROP TABLE IF EXISTS concepts;
+        DROP TABLE IF EXISTS exact_names;
+        DROP TABLE IF EXISTS names;
+        CREATE TABLE concepts (id INTEGER PRIMARY KEY, curie TEXT UNIQUE, label TEXT, biolink_type TEXT, taxa TEXT,
+                               clique_identifier_count INTEGER);
+        CREATE TABLE exact_names (name TEXT, concept_id INTEGER);
+        CREATE VIRTUAL TABLE names USING fts5(name, concept_id UNINDEXED, tokenize='trigram');
+    """)
+    nconcepts = 0
+    for synonyms_file in synonyms_files:
+        with open(synonyms_file, "r") as inf:
+            for line in inf:
+                clique = json.loads(line)
+                names = clique.get("names", [])
+                label = clique.get("preferred_name") or (names[0] if len(names) > 0 else clique["curie"])
+                types = clique.get("types", [])
+                biolink_type = types[0].split(":")[-1] if len(types) > 0 else ""
+                cursor = conn.execute("INSERT OR IGNORE INTO concepts (curie, label, biolink_type, taxa, clique_identifier_count) VALUES (?, ?, ?, ?, ?)",
+                                      (clique["curie"], label, biolink_type, json.dumps(clique.get("taxa", [])),
+                                       clique.get("clique_identifier_count", 1)))
+                if cursor.rowcount == 0:
+                    continue
+                concept_id = cursor.lastrowid
+                keys = list(dict.fromkeys(normalize_term(n) for n in [label] + names))
+                conn.executemany("INSERT INTO exact_names VALUES (?, ?)", [(k, concept_id) for k in keys])
+                conn.executemany("INSERT INTO names VALUES (?, ?)", [(k, concept_id) for k in keys])
+                nconcepts += 1
+                if nconcepts % batch_size == 0:
+                    conn.commit()
+    conn.execute("CREATE INDEX exact_names_name ON exact_names(name)")
+    conn.execute("INSERT INTO names(names) VALUES ('optimize')")
+    conn.commit()
+    conn.close()
+    return nconcepts
+
+if __name__ == "__main__":
+    # python local_index.py index.sqlite synonyms_1.txt [synonyms_2.txt ...]
+    n = build_index(sys.argv[2:], sys.argv[1])
+    print(f"Indexed {n} concepts into {sys.argv[1]}")
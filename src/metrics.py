@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+# Token count histogram bucket upper bounds
+TOKEN_BUCKETS = [50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000]
+
+class Histogram:
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate from the buckets: the upper bound of the bucket holding the q-th observation."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "sum": self.sum, "mean": self.sum / self.count if self.count else None,
+                "min": self.min, "max": self.max, "p50": self.quantile(0.5), "p90": self.quantile(0.9),
+                "p99": self.quantile(0.99)}
+
+class Metrics:
+    """Latency histograms and counters for a run, keyed by name and a service label, and LLM token histograms keyed
+    by the stage that made the call."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.tokens = {}
+        self.counters = {}
+        self.started = time.time()
+
+    def observe(self, name, value, service=""):
+        with self.lock:
+            key = (name, service)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def observe_tokens(self, stage, prompt_tokens, completion_tokens):
+        """Record the prompt and completion tokens of one LLM call made for stage."""
+        with self.lock:
+            for kind, n in (("prompt", prompt_tokens), ("completion", completion_tokens)):
+                key = (stage, kind)
+                if key not in self.tokens:
+                    self.tokens[key] = Histogram(TOKEN_BUCKETS)
+                self.tokens[key].observe(n)
+
+    def count(self, name, n=1, service=""):
+        with self.lock:
+            key = (name, service)
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    @contextmanager
+    def timer(self, name, service=""):
+        """Time the enclosed block as name/service, counting it as an error if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count("errors", service=f"{name}.{service}" if service else name)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, service)
+
+    def timed(self, name, fn, service=""):
+        """fn wrapped in timer(name, service)."""
+        def wrapper(*args, **kwargs):
+            with self.timer(name, service):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def summary(self):
+        with self.lock:
+            counters = dict(self.counters)
+            latencies = {f"{name}.{service}" if service else name: h.summary() for (name, service), h in self.histograms.items()}
+            tokens = {f"{stage}.{kind}" if stage else kind: h.summary() for (stage, kind), h in self.tokens.items()}
+        summary = {"elapsed": time.time() - self.started, "latency": latencies, "tokens": tokens, "counters": {}}
+        for (name, service), n in sorted(counters.items()):
+            summary["counters"][f"{name}.{service}" if service else name] = n
+        for cache in ("llm_cache", "term_cache"):
+            hits = counters.get((f"{cache}.hit", ""), 0)
+            misses = counters.get((f"{cache}.miss", ""), 0)
+            if hits + misses > 0:
+                summary[f"{cache}_hit_rate"] = hits / (hits + misses)
+        return summary
+
+    def write_json(self, path):
+        with open(path, "w") as outf:
+            json.dump(self.summary(), outf, indent=4)
+
+    def prometheus(self):
+        """The metrics in Prometheus text exposition format."""
+        lines = ["# TYPE bagel_latency_seconds histogram"]
+        with self.lock:
+            for (name, service), h in sorted(self.histograms.items()):
+                lines.extend(prometheus_histogram("bagel_latency_seconds", f'stage="{name}",service="{service}"', h))
+            lines.append("# TYPE bagel_llm_tokens histogram")
+            for (stage, kind), h in sorted(self.tokens.items()):
+                lines.extend(prometheus_histogram("bagel_llm_tokens", f'stage="{stage}",kind="{kind}"', h))
+            lines.append("# TYPE bagel_events_total counter")
+            for (name, service), n in sorted(self.counters.items()):
+                lines.append(f'bagel_events_total{{event="{name}",service="{service}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        with open(path, "w") as outf:
+            outf.write(self.prometheus())
+
+def prometheus_histogram(metric, labels, h):
+    lines = []
+    cumulative = 0
+    for bound, n in zip(h.bounds + ["+Inf"], h.counts):
+        cumulative += n
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f"{metric}_sum{{{labels}}} {h.sum}")
+    lines.append(f"{metric}_count{{{labels}}} {h.count}")
+    return lines
+
+# The process-wide metrics that the pipeline records into
+metrics = Metrics()
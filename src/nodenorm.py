@@ -0,0 +1,87 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from metrics import metrics
+
+NODENORM_URL = os.environ.get("NODENORM_URL", "https://nodenormalization-sri.renci.org/get_normalized_nodes")
+
+class CountingRetry(Retry):
+    """Retry that counts each retry it allows in metrics, as "retries" of host/first path segment (which tells
+    NameRes, SAPBERT and NodeNorm apart), since urllib3 otherwise retries silently.  Running out of retries isn't
+    counted here: the caller's metrics.timer counts the error that raises."""
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)
+        host = _pool.host if _pool is not None else ""
+        path = (url or "").split("?")[0].strip("/").split("/")[0]
+        metrics.count("retries", service=f"{host}/{path}")
+        return retry
+
+def make_session(pool_size=10):
+    """A requests Session with the same retry policy we use for NameRes and SAPBERT, and a connection pool
+    large enough to be shared between threads.  Retries are counted in metrics."""
+    session = requests.Session()
+    retries = CountingRetry(total=5,
+                    backoff_factor=0.1,
+                    status_forcelist=[ 500, 502, 503, 504, 403 ],
+                    allowed_methods=None
+                    )
+    adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class NodeNormClient:
+    """Batched client for NodeNormalization.  All curies go out in as few POSTs as possible (chunk_size at a time)
+    rather than one GET per curie."""
+    def __init__(self, session=None, url=None, chunk_size=1000):
+        self.session = session if session is not None else make_session()
+        self.url = url if url is not None else NODENORM_URL
+        self.chunk_size = chunk_size
+
+    def normalize(self, curies, description=False):
+        """Return the raw get_normalized_nodes response for all of the curies, merged across chunks.
+        Curies that fail to normalize map to None, as they do in the NodeNorm response."""
+        curies = list(dict.fromkeys(curies))
+        results = {}
+        for i in range(0, len(curies), self.chunk_size):
+            chunk = curies[i:i+self.chunk_size]
+            payload = {"curies": chunk, "conflate": True, "drug_chemical_conflate": True, "description": description}
+            # Once the session's retries run out on a retried status it raises RetryError rather than returning the
+            # response, so both that and a bad status leave these curies out of the results
+            try:
+                with metrics.timer("normalize", "NodeNorm"):
+                    resp = self.session.post(self.url, json=payload)
+            except requests.RequestException as e:
+                # metrics.timer has already counted the error
+                print("NodeNorm failed", e, "for", len(chunk), "curies")
+                continue
+            if resp.status_code != 200:
+                metrics.count("errors", service="normalize.NodeNorm")
+                print("NodeNorm failed", resp.status_code, "for", len(chunk), "curies")
+                continue
+            results.update(resp.json())
+        return results
+
+    def describe(self, curies, tax_ids, taxes=None):
+        """Fetch descriptions for curies and names for tax_ids in a single batch.  taxes is a {tax_id: name} memo;
+        only tax_ids missing from it are looked up, and it is updated in place.  Returns (descriptions, taxes).
+        Curies that NodeNorm doesn't know get an empty description."""
+        if taxes is None:
+            taxes = {}
+        missing = [t for t in dict.fromkeys(tax_ids) if t not in taxes]
+        result = self.normalize(list(curies) + missing, description=True)
+        descriptions = {}
+        for curie in curies:
+            try:
+                descriptions[curie] = result[curie]["id"].get("description", "")
+            except (KeyError, TypeError):
+                print("No curie?", curie)
+                descriptions[curie] = ""
+        for tax_id in missing:
+            try:
+                taxes[tax_id] = result[tax_id]["id"]["label"]
+            except (KeyError, TypeError):
+                print("No taxon?", tax_id)
+        return descriptions, taxes
@@ -2,38 +2,39 @@
 
 import json
 import csv
-from collections import defaultdict
+import sys
 
-def transform_documents(documents):
-    transformed_data = []
-    header = ['Abstract ID', 'Term', 'Curie', 'Label', 'Label_SourceRank', 'Class_SourceRank', 'ClassDescription_SourceRank']
+DEFAULT_INPUTS = ["bagel_synonyms_1.jsonl", "bagel_synonyms.jsonl"]
+
+HEADER = ['Abstract ID', 'Term', 'Curie', 'Label', 'Label_SourceRank', 'Class_SourceRank', 'ClassDescription_SourceRank']
+
+METHOD_COLUMNS = {'label': 'label_sources', 'class': 'class_sources', 'class_description': 'class_description_sources'}
 
+def iter_rows(documents):
+    """Yield one exact-match row per (abstract, term, curie), one document at a time."""
     for doc in documents:
         abstract_id = doc['abstract_id']
         bagel_results = doc.get('bagel_results', {})
 
         for term, results in bagel_results.items():
-            curie_label_pairs = defaultdict(lambda: {'label': '', 'label_sources': [], 'class_sources': [], 'class_description_sources': []})
+            curie_label_pairs = {}
 
             for method, match_description in results.items():
-                exact_matches = match_description.get('exact', [])
-                for match in exact_matches:
-                    curie = match.get('curie', '')
-                    label = match.get('label', '')
+                column = METHOD_COLUMNS.get(method)
+                for match in match_description.get('exact', []):
                     return_parameters = match.get('return_parameters', [])
-                    for return_param in return_parameters:
-                        source = return_param.get('source', '')
-                        rank = return_param.get('rank', '')
-                        curie_label_pairs[curie]['label'] = label
-                        if method == 'label':
-                            curie_label_pairs[curie]['label_sources'].append(f"{source}_{rank}")
-                        elif method == 'class':
-                            curie_label_pairs[curie]['class_sources'].append(f"{source}_{rank}")
-                        elif method == 'class_description':
-                            curie_label_pairs[curie]['class_description_sources'].append(f"{source}_{rank}")
+                    if len(return_parameters) == 0:
+                        continue
+                    curie = match.get('curie', '')
+                    if curie not in curie_label_pairs:
+                        curie_label_pairs[curie] = {'label': '', 'label_sources': [], 'class_sources': [], 'class_description_sources': []}
+                    data = curie_label_pairs[curie]
+                    data['label'] = match.get('label', '')
+                    if column is not None:
+                        data[column].extend(f"{p.get('source', '')}_{p.get('rank', '')}" for p in return_parameters)
 
             for curie, data in curie_label_pairs.items():
-                transformed_data.append([
+                yield [
                     abstract_id,
                     term,
                     curie,
@@ -41,29 +42,69 @@ def transform_documents(documents):
                     ','.join(data['label_sources']),
                     ','.join(data['class_sources']),
                     ','.join(data['class_description_sources'])
-                ])
+                ]
+
+def transform_documents(documents):
+    return list(iter_rows(documents)), HEADER
+
+def iter_batches(rows, batch_size=65536):
+    """Group rows into column-oriented batches: {column name: list of values}."""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield dict(zip(HEADER, map(list, zip(*batch))))
+            batch = []
+    if len(batch) > 0:
+        yield dict(zip(HEADER, map(list, zip(*batch))))
 
-    return transformed_data, header
+def arrow_schema():
+    import pyarrow as pa
+    return pa.schema([(name, pa.int64() if name == 'Abstract ID' else pa.string()) for name in HEADER])
 
 def write_to_file(data, header, filename):
-    with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, delimiter='\t')
-        writer.writerow(header)
-        for row in data:
-            writer.writerow(row)
-
-def load_docs():
-    docs = []
-    for infilename in ["bagel_synonyms_1.jsonl", "bagel_synonyms.jsonl"]:
-        with open("bagel_synonyms_1.jsonl") as inf:
+    """Write rows to filename.  The format comes from the extension: .parquet, .arrow/.feather, or tab separated."""
+    if filename.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(filename, arrow_schema())
+        for batch in iter_batches(data):
+            writer.write_batch(pa.RecordBatch.from_pydict(batch, schema=arrow_schema()))
+        writer.close()
+    elif filename.endswith('.arrow') or filename.endswith('.feather'):
+        import pyarrow as pa
+        with pa.OSFile(filename, 'wb') as sink, pa.ipc.new_file(sink, arrow_schema()) as writer:
+            for batch in iter_batches(data):
+                writer.write_batch(pa.RecordBatch.from_pydict(batch, schema=arrow_schema()))
+    else:
+        with open(filename, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, delimiter='\t')
+            writer.writerow(header)
+            writer.writerows(data)
+
+def exact_matches_table(filenames=DEFAULT_INPUTS):
+    """The exact-match table as a pyarrow Table."""
+    import pyarrow as pa
+    batches = [pa.RecordBatch.from_pydict(batch, schema=arrow_schema()) for batch in iter_batches(iter_rows(iter_docs(filenames)))]
+    return pa.Table.from_batches(batches, schema=arrow_schema())
+
+def exact_matches_frame(filenames=DEFAULT_INPUTS):
+    """The exact-match table as a pandas DataFrame."""
+    return exact_matches_table(filenames).to_pandas()
+
+def iter_docs(filenames=DEFAULT_INPUTS):
+    for infilename in filenames:
+        with open(infilename) as inf:
             for line in inf:
-                docs.append(json.loads(line.strip()))
-    return docs
+                if line.strip():
+                    yield json.loads(line)
+
+def load_docs(filenames=DEFAULT_INPUTS):
+    return list(iter_docs(filenames))
 
-def go():
-    documents = load_docs()
-    transformed_data, header = transform_documents(documents)
-    write_to_file(transformed_data, header, 'transformed_data.tsv')
+def go(filenames=DEFAULT_INPUTS, outfile='transformed_data.tsv'):
+    write_to_file(iter_rows(iter_docs(filenames)), HEADER, outfile)
 
 if __name__ == '__main__':
-    go()
+    # python parse_exacts.py [output.tsv|output.parquet|output.arrow]
+    go(outfile=sys.argv[1] if len(sys.argv) > 1 else 'transformed_data.tsv')
@@ -0,0 +1,83 @@
+import re
+from collections import defaultdict
+
+from candidates import Judgment
+
+def normalize_label(label):
+    """Case- and punctuation-insensitive form of a label, for comparing it to a query term."""
+    return " ".join(re.sub(r"[^\w\s]", " ", label.casefold()).split())
+
+class Prefilter:
+    """Deterministic pruning of a term's candidates before they go to GPT.
+
+    Candidates whose normalized label and class duplicate a better ranked candidate are left out of the prompt and
+    take that candidate's answer.  Candidates scoring below min_scores[source] (or ranked worse than max_rank) with
+    every source that returned them are left out and come back as unrelated.  If short_circuit is set and one
+    candidate's normalized label is the query term and every one of sources (the engines candidates come from)
+    ranked it first, GPT is skipped and that candidate is the exact match."""
+    def __init__(self, sources, min_scores=None, max_rank=None, short_circuit=True):
+        self.sources = set(sources)
+        self.min_scores = min_scores if min_scores is not None else {}
+        self.max_rank = max_rank
+        self.short_circuit = short_circuit
+
+    def keep(self, annotation):
+        for r in annotation.return_parameters:
+            if self.max_rank is not None and r.rank > self.max_rank:
+                continue
+            if r.source in self.min_scores and float(r.score) < self.min_scores[r.source]:
+                continue
+            return True
+        return False
+
+    def plan(self, term, termlist):
+        """Decide what to send to GPT for term.  Returns (prompt_terms, aliases, exact): the candidates to put in the
+        prompt, {duplicate curie: representative curie}, and the curie of a short-circuited exact match (in which
+        case prompt_terms is None)."""
+        def best_rank(curie):
+            return min((r.rank for r in termlist[curie].return_parameters), default=float("inf"))
+
+        aliases = {}
+        representatives = {}
+        for curie in sorted(termlist, key=best_rank):
+            annotation = termlist[curie]
+            key = (normalize_label(annotation.label or ""), annotation.biolink_type)
+            if key in representatives:
+                aliases[curie] = representatives[key]
+            else:
+                representatives[key] = curie
+
+        if self.short_circuit:
+            query = normalize_label(term)
+            matches = [curie for curie in representatives.values()
+                       if normalize_label(termlist[curie].label or "") == query
+                       and set(r.source for r in termlist[curie].return_parameters if r.rank == 1) >= self.sources]
+            if len(matches) == 1:
+                return None, aliases, matches[0]
+
+        prompt_terms = {curie: termlist[curie] for curie in termlist
+                        if curie not in aliases and self.keep(termlist[curie])}
+        return prompt_terms, aliases, None
+
+def expand(termlist, grouped, aliases):
+    """Rebuild a full grouped_by_syntype for every candidate in termlist from GPT's grouping of the pruned prompt
+    candidates.  Aliases take their representative's synonym type, and pruned candidates are unrelated."""
+    syntypes = {}
+    for syntype, judgments in grouped.items():
+        for judgment in judgments:
+            syntypes[judgment.curie] = syntype
+    return regroup(termlist, syntypes, aliases)
+
+def short_circuit(termlist, exact, aliases):
+    """The grouped_by_syntype for a term whose exact match was decided without GPT."""
+    return regroup(termlist, {exact: "exact"}, aliases)
+
+def regroup(termlist, syntypes, aliases):
+    for curie, representative in aliases.items():
+        if representative in syntypes:
+            syntypes[curie] = syntypes[representative]
+    grouped_by_syntype = defaultdict(list)
+    for curie in termlist:
+        syntype = syntypes.get(curie, "unrelated")
+        grouped_by_syntype[syntype].append(Judgment(termlist[curie], syntype))
+    return grouped_by_syntype
@@ -0,0 +1,63 @@
+import json
+import threading
+
+from candidates import candidates_digest
+
+def output_candidates(results):
+    """The candidates of one term's bagel_results, gathered from its grouped judgments."""
+    candidates = {}
+    for grouped in results.values():
+        for judgments in grouped.values():
+            for candidate in judgments:
+                candidates[candidate["curie"]] = candidate
+    return candidates.values()
+
+class PreviousOutput:
+    """An index of an earlier bagel output file by (abstract_id, term, candidate digest), so that a rerun over
+    regenerated extractions can reuse the results of pairs whose candidates haven't changed.  Only the digests and
+    each abstract's offset in the file are held in memory; reused results are read back from the file."""
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}
+        self.digests = {}
+        self.reused = 0
+        self.recomputed = 0
+        self.lock = threading.Lock()
+        with open(path, "rb") as inf:
+            while True:
+                offset = inf.tell()
+                line = inf.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                abstract_id = str(doc["abstract_id"])
+                self.offsets[abstract_id] = offset
+                for term, results in doc["bagel_results"].items():
+                    self.digests[(abstract_id, term)] = candidates_digest(output_candidates(results))
+        self.inf = open(path, "rb")
+
+    def reusable(self, abstract_id, digests):
+        """The previous bagel_results for each term of abstract_id whose candidate digest (in digests, {term: digest})
+        is unchanged."""
+        abstract_id = str(abstract_id)
+        terms = [term for term, digest in digests.items() if self.digests.get((abstract_id, term)) == digest]
+        with self.lock:
+            self.reused += len(terms)
+            self.recomputed += len(digests) - len(terms)
+            if len(terms) == 0:
+                return {}
+            self.inf.seek(self.offsets[abstract_id])
+            line = self.inf.readline()
+        previous = json.loads(line)["bagel_results"]
+        return {term: previous[term] for term in terms}
+
+    def stats(self):
+        total = self.reused + self.recomputed
+        return {"abstracts": len(self.offsets), "reused": self.reused, "recomputed": self.recomputed,
+                "reuse_rate": self.reused / total if total > 0 else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.inf.close()
@@ -0,0 +1,70 @@
+import atexit
+import json
+import sys
+import threading
+import time
+
+class PromptLog:
+    """Append-only JSONL log.  Records are buffered and written out every flush_every records or flush_interval
+    seconds, whichever comes first, so a crash loses at most the unflushed tail and never the earlier records."""
+    def __init__(self, path, flush_every=100, flush_interval=5.0):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.outf = open(path, "a")
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.outf.write(line)
+            self.pending += 1
+            if self.pending >= self.flush_every or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.outf.flush()
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if not self.outf.closed:
+                self.outf.close()
+
+# One writer per path, shared by every caller in the process
+logs = {}
+logs_lock = threading.Lock()
+
+def get_log(path):
+    with logs_lock:
+        if path not in logs:
+            logs[path] = PromptLog(path)
+        return logs[path]
+
+@atexit.register
+def close_logs():
+    with logs_lock:
+        for log in logs.values():
+            log.close()
+        logs.clear()
+
+def convert_json_log(in_path, out_path):
+    """Convert an old gpt_out_*.json log (one JSON array of records) into JSONL, appending to out_path."""
+    with open(in_path, "r") as inf:
+        records = json.load(inf)
+    with open(out_path, "a") as outf:
+        for record in records:
+            outf.write(json.dumps(record) + "\n")
+    return len(records)
+
+if __name__ == "__main__":
+    # python prompt_log.py gpt_out_label.json gpt_out_label.jsonl
+    n = convert_json_log(sys.argv[1], sys.argv[2])
+    print(f"Wrote {n} records to {sys.argv[2]}")
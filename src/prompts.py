@@ -0,0 +1,70 @@
+import re
+
+# tiktoken encoding, loaded on first use; False if tiktoken isn't installed
+encoding = None
+
+def get_encoding():
+    global encoding
+    if encoding is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.get_encoding("cl100k_base")
+        except ImportError:
+            encoding = False
+    return encoding
+
+def count_tokens(text):
+    """Tokens in text, with tiktoken if it's installed and about four characters per token if not."""
+    enc = get_encoding()
+    if enc:
+        return len(enc.encode(text))
+    return len(text) // 4 + 1
+
+def truncate_tokens(text, budget):
+    """text cut to at most budget tokens, ending in "..." if anything was cut."""
+    if budget is None or count_tokens(text) <= budget:
+        return text
+    enc = get_encoding()
+    if enc:
+        return enc.decode(enc.encode(text)[:budget]).rstrip() + "..."
+    return text[:budget * 4].rstrip() + "..."
+
+def split_sentences(text):
+    return [s for s in re.split(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])", text.strip()) if s]
+
+def abstract_window(text, terms, sentences=1):
+    """The sentences of text that mention any of terms, with sentences more on either side, in their original
+    order.  Gaps are marked with "...".  If no term is mentioned the whole text is returned."""
+    parts = split_sentences(text)
+    needles = [t.casefold() for t in terms if t.strip()]
+    mentions = [i for i, part in enumerate(parts) if any(n in part.casefold() for n in needles)]
+    if len(mentions) == 0:
+        return text
+    keep = sorted(set(j for i in mentions for j in range(max(0, i - sentences), min(len(parts), i + sentences + 1))))
+    window = []
+    for previous, i in zip([None] + keep, keep):
+        if (previous is None and i > 0) or (previous is not None and i > previous + 1):
+            window.append("...")
+        window.append(parts[i])
+    if keep[-1] < len(parts) - 1:
+        window.append("...")
+    return " ".join(window)
+
+def cell(value):
+    """A value made safe for one cell of a row: no newlines or column separators."""
+    return re.sub(r"\s+", " ", str(value).replace("|", "/")).strip()
+
+def numbered_rows(rows):
+    """Serialize rows (tuples of cells) as "1 | a | b" lines, numbered from 1, for the response to refer to.  Empty
+    trailing cells are left off."""
+    lines = []
+    for i, row in enumerate(rows):
+        cells = [cell(c) for c in row]
+        while len(cells) > 1 and cells[-1] == "":
+            cells.pop()
+        lines.append(f"    {i+1} | " + " | ".join(cells))
+    return "\n".join(lines)
+
+def describe(descriptions, budget):
+    """The non-empty descriptions of one synonym, each truncated to budget tokens, as a single cell."""
+    return "; ".join(truncate_tokens(d, budget) for d in dict.fromkeys(descriptions) if d)
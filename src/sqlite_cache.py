@@ -0,0 +1,101 @@
+import sqlite3
+import threading
+import time
+
+class SQLiteCache:
+    """A table of cached values in SQLite, keyed by a string, with an age limit and LRU eviction.  Subclasses give
+    the table name and the columns they store between the key and the timestamps.
+
+    Entries older than max_age seconds are ignored and dropped, and once there are more than max_entries the least
+    recently used ones are evicted, down to evict_to of max_entries so that eviction runs once per batch of stores
+    rather than on every one.  Either limit can be None.  A read_only cache never writes: lookups don't touch
+    last_used, expired entries are still returned, and nothing is stored or evicted."""
+    table = None
+    columns = ()
+    evict_to = 0.9
+
+    def __init__(self, path, max_entries=None, max_age=None, read_only=False):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        columns = "".join(f"{column} TEXT, " for column in self.columns)
+        self.conn.execute(f"""CREATE TABLE IF NOT EXISTS {self.table} (
+                              key TEXT PRIMARY KEY, {columns}created REAL, last_used REAL)""")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table}(last_used)")
+        self.conn.commit()
+        # Kept up to date by this connection, so that store() only has to evict when the limit is exceeded.  Other
+        # processes sharing the file can make it drift, so eviction counts again before trimming.
+        self.rows = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def lookup(self, key, column):
+        """column of the entry for key, or None on a miss.  Counts the hit or miss."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(f"SELECT {column}, created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+            if row is not None and not self.read_only and self.expired(row[1], now):
+                self.rows -= self.conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,)).rowcount
+                self.conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute(f"UPDATE {self.table} SET last_used = ? WHERE key = ?", (now, key))
+                self.conn.commit()
+            return row[0]
+
+    def store(self, key, values):
+        """Insert or replace the entry for key, with values for the subclass's columns."""
+        if self.read_only:
+            return
+        now = time.time()
+        placeholders = ", ".join("?" * (len(self.columns) + 3))
+        with self.lock:
+            if self.conn.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone() is None:
+                self.rows += 1
+            self.conn.execute(f"INSERT OR REPLACE INTO {self.table} VALUES ({placeholders})", (key, *values, now, now))
+            if self.max_entries is not None and self.rows > self.max_entries:
+                self._evict(now)
+            self.conn.commit()
+
+    def has(self, key):
+        """Whether there is an unexpired entry for key, without counting it as a hit or miss."""
+        with self.lock:
+            row = self.conn.execute(f"SELECT created FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        return row is not None and not self.expired(row[0], time.time())
+
+    def expired(self, created, now):
+        return self.max_age is not None and created < now - self.max_age
+
+    def evict(self):
+        """Apply the age and size limits now."""
+        if self.read_only:
+            return
+        with self.lock:
+            self._evict(time.time())
+            self.conn.commit()
+
+    def _evict(self, now):
+        """Drop expired entries, then the least recently used down to evict_to of max_entries if that is exceeded."""
+        if self.max_age is not None:
+            self.conn.execute(f"DELETE FROM {self.table} WHERE created < ?", (now - self.max_age,))
+        self.rows = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+        if self.max_entries is not None and self.rows > self.max_entries:
+            keep = int(self.max_entries * self.evict_to)
+            self.rows -= self.conn.execute(f"""DELETE FROM {self.table} WHERE key IN
+                                               (SELECT key FROM {self.table} ORDER BY last_used LIMIT ?)""",
+                                           (self.rows - keep,)).rowcount
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0.0}
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
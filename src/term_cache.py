@@ -0,0 +1,32 @@
+import json
+import re
+
+from candidates import CandidateSet
+from sqlite_cache import SQLiteCache
+
+def normalize_term(term):
+    """Case- and whitespace-insensitive key for a surface string, so that "HIV" and " hiv" share an entry."""
+    return re.sub(r"\s+", " ", term).strip().casefold()
+
+class TermCache(SQLiteCache):
+    """On-disk cache of merged candidate sets (the CandidateSets built by update_by_id and augment_results), keyed
+    by normalized term.  These don't depend on the abstract, so a term only needs NameRes, SAPBERT, reverse_lookup
+    and NodeNorm once across all abstracts and runs.  ttl is the base class's max_age."""
+    table = "candidates"
+    columns = ("candidates",)
+
+    def __init__(self, path="term_cache.sqlite", ttl=30*24*60*60, max_entries=200000):
+        super().__init__(path, max_entries=max_entries, max_age=ttl)
+
+    def get(self, term):
+        """Return a fresh copy of the cached candidates for term, or None on a miss."""
+        blob = self.lookup(normalize_term(term), "candidates")
+        if blob is None:
+            return None
+        return CandidateSet.from_json(json.loads(blob))
+
+    def put(self, term, candidates):
+        self.store(normalize_term(term), (json.dumps(candidates.to_json()),))
+
+    def __contains__(self, term):
+        return self.has(normalize_term(term))